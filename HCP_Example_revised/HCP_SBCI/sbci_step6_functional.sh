@@ -46,14 +46,15 @@ while IFS= read -r -d '' FCDIR; do
 
 done < ./dwi_pipeline/sbci_connectome/fcruns
 
-# Step2) Join all the runs into a single timeseries
+# Step2) Join all the runs into a single timeseries (a directory with a .npy file per key,
+#        which calculate_fc.py memory-maps)
 python ${SCRIPT_PATH}/concatenate_timeseries.py \
        --time_series ${TS_LIST} \
-       --output ./dwi_pipeline/sbci_connectome/fc_ts.npz -f
+       --output ./dwi_pipeline/sbci_connectome/fc_ts -f
 
 # Step3) Calculate FC matrix at the given resolution in template space
 python ${SCRIPT_PATH}/calculate_fc.py \
-       --time_series ./dwi_pipeline/sbci_connectome/fc_ts.npz \
+       --time_series ./dwi_pipeline/sbci_connectome/fc_ts \
        --mesh ${OUTPUT_PATH}/mapping_avg_${RESOLUTION}.npz \
        --output ./dwi_pipeline/sbci_connectome/fc_avg_${RESOLUTION}.mat --ts -f
 
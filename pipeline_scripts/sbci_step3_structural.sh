@@ -33,22 +33,36 @@ python ${SCRIPT_PATH}/snap_fibers.py \
 ##            GROUP SPACE STRUCTURAL CONNECTIVITY             ## 
 ################################################################
 
-# Step1) Register WM fibers to the average sphere
-python ${SCRIPT_PATH}/group/register_sc.py \
-       --lh_surface ${OUTPUTDIR}/lh_sphere_reg_lps_norm.vtk \
-       --lh_average ${AVGDIR}/lh_sphere_avg_norm.vtk \
-       --rh_surface ${OUTPUTDIR}/rh_sphere_reg_lps_norm.vtk \
-       --rh_average ${AVGDIR}/rh_sphere_avg_norm.vtk \
-       --snapped_fibers ${OUTPUTDIR}/snapped_fibers.npz \
-       --output ${OUTPUTDIR}/registered_fibers.npz -f
-
-# Step2) Calculate discrete SC matrix
+# Step1-2) Register WM fibers to the average sphere and calculate the full resolution endpoint histogram,
+#          SC at any resolution is calculated from this. If SC_ACCUMULATE=1 in the config, each SET run
+#          was already added to its own histogram by set_step2_tracking_random_seed_n.sh instead (the
+#          concatenated and snapped fibers above are still needed for the smooth and subcortical SC)
+if [ "${SC_ACCUMULATE:-0}" = "1" ]; then
+  HISTOGRAM=${OUTPUTDIR}/endpoint_histogram_accumulated_avg.npz
+else
+  HISTOGRAM=${OUTPUTDIR}/endpoint_histogram_avg.npz
+
+  python ${SCRIPT_PATH}/group/register_sc.py \
+         --lh_surface ${OUTPUTDIR}/lh_sphere_reg_lps_norm.vtk \
+         --lh_average ${AVGDIR}/lh_sphere_avg_norm.vtk \
+         --rh_surface ${OUTPUTDIR}/rh_sphere_reg_lps_norm.vtk \
+         --rh_average ${AVGDIR}/rh_sphere_avg_norm.vtk \
+         --snapped_fibers ${OUTPUTDIR}/snapped_fibers.npz \
+         --output ${OUTPUTDIR}/registered_fibers.npz -f
+
+  python ${SCRIPT_PATH}/calculate_endpoint_histogram.py \
+         --intersections ${OUTPUTDIR}/registered_fibers.npz \
+         --mesh ${AVGDIR}/mapping_avg_${RESOLUTION}.npz \
+         --output ${HISTOGRAM} -f
+fi
+
+# Step3) Calculate discrete SC matrix
 python ${SCRIPT_PATH}/calculate_sc.py \
-       --intersections ${OUTPUTDIR}/registered_fibers.npz \
+       --histogram ${HISTOGRAM} \
        --mesh ${AVGDIR}/mapping_avg_${RESOLUTION}.npz \
        --output ${OUTPUTDIR}/sc_avg_${RESOLUTION}.mat --count -f
 
-# Step3) Calculate smooth SC matrix
+# Step4) Calculate smooth SC matrix
 python ${SCRIPT_PATH}/concon/intersections_to_sphere.py \
        --lh_surface ${OUTPUTDIR}/lh_sphere_reg_lps.vtk \
        --rh_surface ${OUTPUTDIR}/rh_sphere_reg_lps.vtk \
@@ -82,7 +96,25 @@ python ${SCRIPT_PATH}/concon/convert_raw.py \
        --mesh ${AVGDIR}/mapping_avg_${RESOLUTION}.npz \
        --output ${OUTPUTDIR}/smoothed_sc_avg_${BANDWIDTH}_${RESOLUTION} -f
 
-# Step4) Calculate subcortical SC matrices
+###############################################################################
+## Optionally store the smoothed SC as spherical harmonic coefficients, whose ##
+## size does not depend on RESOLUTION, and evaluate them on any grid later    ##
+## (grid_coords_${RESOLUTION}.npz is made in Step5 of sbci_step1, and         ##
+## --reference compares the result to the concon output on the same grid)     ##
+###############################################################################
+#python ${SCRIPT_PATH}/concon/compute_harmonics.py \
+#       --intersections ${OUTPUTDIR}/subject_xing_sphere_avg_coords.tsv \
+#       --sigma ${BANDWIDTH} \
+#       --num_harm 33 \
+#       --output ${OUTPUTDIR}/smoothed_sc_harmonics_${BANDWIDTH}.npz -f
+#
+#python ${SCRIPT_PATH}/concon/evaluate_harmonics.py \
+#       --harmonics ${OUTPUTDIR}/smoothed_sc_harmonics_${BANDWIDTH}.npz \
+#       --grid ${AVGDIR}/grid_coords_${RESOLUTION}.npz \
+#       --reference ${OUTPUTDIR}/smoothed_sc_avg_${BANDWIDTH}_${RESOLUTION}.npz \
+#       --output ${OUTPUTDIR}/smoothed_sc_harmonics_avg_${BANDWIDTH}_${RESOLUTION}.h5 -f
+
+# Step5) Calculate subcortical SC matrices
 python ${SCRIPT_PATH}/calculate_subcortical_sc.py \
        --intersections ${OUTPUTDIR}/snapped_fibers.npz \
        --grid ${AVGDIR}/grid_coords_${RESOLUTION}.npz \
@@ -10,47 +10,73 @@ source ${SBCI_CONFIG}
 # possible to concatenate BOLD time series instead of treating them individually)
 find ./fsfast/t1_freesurfer/bold/ -regextype sed -regex ".*/[0-9][0-9][0-9]" -type d -print0 > ${OUTPUTDIR}/fcruns 
 
-run=1
+# Step1) Calculate FC residual time series (wm, motion, vcsf, gsl) and the FC matrix at the given
+#        resolution for all runs at once, saved to ${OUTPUTDIR}/RUN### in the order of fcruns
+#        (set FC_PROCESSES in the config to process several runs in parallel, and FC_FLOAT32
+#        to save the time series and FC in single precision)
+RUNS=()
 
 while IFS= read -r -d '' FCDIR; do
+  RUNS+=("${FCDIR}")
+done < ${OUTPUTDIR}/fcruns
 
-  FCOUTPUTDIR=${OUTPUTDIR}/RUN$(printf '%03d' $run)
-
-  mkdir -p ${FCOUTPUTDIR}
-
-  # Step1) Calculate FC residual time series (wm, motion, vcsf, gsl)
-  python ${SCRIPT_PATH}/calculate_residual_timeseries.py \
-         --lh_time_series ${FCDIR}/fmcpr.sm5.fsaverage.lh.nii.gz \
-         --rh_time_series ${FCDIR}/fmcpr.sm5.fsaverage.rh.nii.gz \
-         --sub_time_series ${FCDIR}/fmcpr.sm5.mni305.2mm.nii.gz \
+# (skipped if the subject has no BOLD runs)
+if [ ${#RUNS[@]} -gt 0 ]; then
+  python ${SCRIPT_PATH}/calculate_functional_runs.py \
+         --runs "${RUNS[@]}" \
+         --mesh ${AVGDIR}/mapping_avg_${RESOLUTION}.npz \
          --aparc ${REFDIR}/mri.2mm/aseg.mgz \
          --sub_rois ${ROIS[*]} \
-         --motion ${FCDIR}/fmcpr.mcdat \
-         --wm ${FCDIR}/wm.dat \
-         --vcsf ${FCDIR}/vcsf.dat \
-         --gsl ${FCDIR}/global.waveform.dat \
-         --output ${FCOUTPUTDIR}/fc_ts_partial.npz -f
-
-  # Step2) Register the BOLD time series to template space
-  #############################################################################
-  ## Assuming bold series is already in template space through fs fast,      ##
-  ## otherwise uncomment below and change input and output names accordingly ##
-  #############################################################################
-  #python ${SCRIPT_PATH}/group/register_fc.py \
-  #       --lh_surface ${OUTPUTDIR}/lh_sphere_reg_lps_norm.vtk \
-  #       --lh_average ${AVGDIR}/lh_sphere_avg_norm.vtk \
-  #       --rh_surface ${OUTPUTDIR}/rh_sphere_reg_lps_norm.vtk \
-  #       --rh_average ${AVGDIR}/rh_sphere_avg_norm.vtk \
-  #       --time_series ${FCOUTPUTDIR}/fc_ts_partial.npz \
-  #       --output ${FCOUTPUTDIR}/registered_fc_ts_partial.npz -f
-
-  # Step3) Calculate FC matrix at the given resolution in template space
-  python ${SCRIPT_PATH}/calculate_fc.py \
-         --time_series ${FCOUTPUTDIR}/fc_ts_partial.npz \
-         --mesh ${AVGDIR}/mapping_avg_${RESOLUTION}.npz \
-         --output ${FCOUTPUTDIR}/fc_partial_avg_${RESOLUTION}.mat -f
-
-  run=$((run + 1))
-
-done < ${OUTPUTDIR}/fcruns
+         --output_dir ${OUTPUTDIR} \
+         --fc_output fc_partial_avg_${RESOLUTION}.mat \
+         --average ${OUTPUTDIR}/fc_partial_avg_${RESOLUTION}_mean.mat \
+         --processes ${FC_PROCESSES:-1} ${FC_FLOAT32:+--float32} -f
+fi
 
+#################################################################################
+## If the BOLD time series need to be registered to template space, calculate  ##
+## each run separately instead (uncomment below and change names accordingly)  ##
+#################################################################################
+#run=1
+#
+#while IFS= read -r -d '' FCDIR; do
+#
+#  FCOUTPUTDIR=${OUTPUTDIR}/RUN$(printf '%03d' $run)
+#
+#  mkdir -p ${FCOUTPUTDIR}
+#
+#  # Step1) Calculate FC residual time series (wm, motion, vcsf, gsl)
+#  python ${SCRIPT_PATH}/calculate_residual_timeseries.py \
+#         --lh_time_series ${FCDIR}/fmcpr.sm5.fsaverage.lh.nii.gz \
+#         --rh_time_series ${FCDIR}/fmcpr.sm5.fsaverage.rh.nii.gz \
+#         --sub_time_series ${FCDIR}/fmcpr.sm5.mni305.2mm.nii.gz \
+#         --aparc ${REFDIR}/mri.2mm/aseg.mgz \
+#         --sub_rois ${ROIS[*]} \
+#         --motion ${FCDIR}/fmcpr.mcdat \
+#         --wm ${FCDIR}/wm.dat \
+#         --vcsf ${FCDIR}/vcsf.dat \
+#         --gsl ${FCDIR}/global.waveform.dat \
+#         --output ${FCOUTPUTDIR}/fc_ts_partial.npz -f
+#
+#  # Step2) Register the BOLD time series to template space
+#  #############################################################################
+#  ## Assuming bold series is already in template space through fs fast,      ##
+#  ## otherwise uncomment below and change input and output names accordingly ##
+#  #############################################################################
+#  #python ${SCRIPT_PATH}/group/register_fc.py \
+#  #       --lh_surface ${OUTPUTDIR}/lh_sphere_reg_lps_norm.vtk \
+#  #       --lh_average ${AVGDIR}/lh_sphere_avg_norm.vtk \
+#  #       --rh_surface ${OUTPUTDIR}/rh_sphere_reg_lps_norm.vtk \
+#  #       --rh_average ${AVGDIR}/rh_sphere_avg_norm.vtk \
+#  #       --time_series ${FCOUTPUTDIR}/fc_ts_partial.npz \
+#  #       --output ${FCOUTPUTDIR}/registered_fc_ts_partial.npz -f
+#
+#  # Step3) Calculate FC matrix at the given resolution in template space
+#  python ${SCRIPT_PATH}/calculate_fc.py \
+#         --time_series ${FCOUTPUTDIR}/fc_ts_partial.npz \
+#         --mesh ${AVGDIR}/mapping_avg_${RESOLUTION}.npz \
+#         --output ${FCOUTPUTDIR}/fc_partial_avg_${RESOLUTION}.mat -f
+#
+#  run=$((run + 1))
+#
+#done < ${OUTPUTDIR}/fcruns
@@ -3,6 +3,8 @@
 source ${SBCI_CONFIG}
 
 idx=0
+ATLASES=""
+MASKS=""
 
 for PARCELLATION in ${ATLAS_PARCELLATIONS[*]}; do
 
@@ -15,25 +17,35 @@ for PARCELLATION in ${ATLAS_PARCELLATIONS[*]}; do
          --atlas ${AVGDIR}/${PARCELLATION}_avg_roi_${RESOLUTION}.npz \
          --mask_indices ${ATLAS_ROI_MASKS[$idx]} \
          --output ${OUTPUTDIR}/${PARCELLATION}_csc.mat -f
-  
-  run=1
 
-  while IFS= read -r -d '' FCDIR; do
+  # collect the atlases for the continuous FC (calculated for all atlases at once)
+  ATLASES="${ATLASES} ${AVGDIR}/${PARCELLATION}_avg_roi_${RESOLUTION}.npz"
+  MASKS="${MASKS} --mask_indices ${ATLAS_ROI_MASKS[$idx]}"
 
-    FCOUTPUTDIR=${OUTPUTDIR}/RUN$(printf '%03d' $run)
+  idx=$((idx + 1))
 
-    # Step2) Calculate continuous FC (wm, motion, vcsf, gsl, confounders)
-    python ${SCRIPT_PATH}/calculate_approx_continuous_fc.py \
-           --time_series ${FCOUTPUTDIR}/fc_ts_partial.npz \
-           --mesh ${AVGDIR}/mapping_avg_${RESOLUTION}.npz \
-           --atlas ${AVGDIR}/${PARCELLATION}_avg_roi_${RESOLUTION}.npz \
-           --mask_indices ${ATLAS_ROI_MASKS[$idx]} \
-           --output ${FCOUTPUTDIR}/${PARCELLATION}_cfc.mat -f
+done
 
-    run=$((run + 1))
+run=1
 
-  done < ${OUTPUTDIR}/fcruns
+while IFS= read -r -d '' FCDIR; do
 
-  idx=$((idx + 1))
+  FCOUTPUTDIR=${OUTPUTDIR}/RUN$(printf '%03d' $run)
 
-done
+  OUTPUTS=""
+
+  for PARCELLATION in ${ATLAS_PARCELLATIONS[*]}; do
+    OUTPUTS="${OUTPUTS} ${FCOUTPUTDIR}/${PARCELLATION}_cfc.mat"
+  done
+
+  # Step2) Calculate continuous FC for every atlas (wm, motion, vcsf, gsl, confounders)
+  python ${SCRIPT_PATH}/calculate_approx_continuous_fc.py \
+         --time_series ${FCOUTPUTDIR}/fc_ts_partial.npz \
+         --mesh ${AVGDIR}/mapping_avg_${RESOLUTION}.npz \
+         --atlas ${ATLASES} \
+         ${MASKS} \
+         --output ${OUTPUTS} ${FC_FLOAT32:+--float32} -f
+
+  run=$((run + 1))
+
+done < ${OUTPUTDIR}/fcruns
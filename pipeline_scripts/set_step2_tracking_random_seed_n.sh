@@ -75,3 +75,30 @@ scil_surface_filtering.py set/out_surf/flow_${STEPS}_1.vtk \
         --out_intersections set/streamline/intersections_random_loop${RUN}_filtered.npz \
         --min_length 10 \
         --max_length 250 -f
+
+#####################################################################################
+## If SC_ACCUMULATE=1 in the config, add this run to the subject's endpoint         ##
+## histogram as soon as it has finished, instead of calculating the histogram from ##
+## the concatenated intersections in sbci_step3_structural.sh                      ##
+#####################################################################################
+if [ "${SC_ACCUMULATE:-0}" = "1" ]; then
+  python ${SCRIPT_PATH}/snap_fibers.py \
+         --surfaces set/out_surf/surfaces.vtk \
+         --surface_map set/preprocess/surfaces_id.npy \
+         --intersections set/streamline/intersections_random_loop${RUN}_filtered.npz \
+         --output set/streamline/snapped_fibers_random_loop${RUN}.npz -f
+
+  python ${SCRIPT_PATH}/group/register_sc.py \
+         --lh_surface ../${OUTPUTDIR}/lh_sphere_reg_lps_norm.vtk \
+         --lh_average ${AVGDIR}/lh_sphere_avg_norm.vtk \
+         --rh_surface ../${OUTPUTDIR}/rh_sphere_reg_lps_norm.vtk \
+         --rh_average ${AVGDIR}/rh_sphere_avg_norm.vtk \
+         --snapped_fibers set/streamline/snapped_fibers_random_loop${RUN}.npz \
+         --output set/streamline/registered_fibers_random_loop${RUN}.npz -f
+
+  python ${SCRIPT_PATH}/accumulate_sc.py \
+         --intersections set/streamline/registered_fibers_random_loop${RUN}.npz \
+         --run ${RUN} \
+         --mesh ${AVGDIR}/mapping_avg_${RESOLUTION}.npz \
+         --histogram ../${OUTPUTDIR}/endpoint_histogram_accumulated_avg.npz
+fi
@@ -0,0 +1,122 @@
+import argparse
+import fcntl
+import logging
+import os
+
+import numpy as np
+
+from scipy import sparse
+from os.path import isfile
+from connectivity import load_endpoints, endpoint_histogram
+
+DESCRIPTION = """
+  Add the tract endpoints of a single SET run to a per-subject endpoint histogram (the same
+  format as calculate_endpoint_histogram.py), recording which runs it contains. This allows the
+  histogram to be built as each run finishes, without concatenating the intersections of all runs.
+"""
+
+
+def _build_args_parser():
+    p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                description=DESCRIPTION)
+
+    p.add_argument('--intersections', action='store', metavar='INTERSECTIONS', required=True,
+                   type=str, help='Path of the .npz file of intersections of the run that have been snapped to nearest vertices.')
+
+    p.add_argument('--run', action='store', metavar='RUN', required=True,
+                   type=int, help='Number of the SET run the intersections belong to.')
+
+    p.add_argument('--mesh', action='store', metavar='MESH', required=True,
+                   type=str, help='Path to any downsampled mesh .npz file of the full resolution surface.')
+
+    p.add_argument('--histogram', action='store', metavar='HISTOGRAM', required=True,
+                   type=str, help='Path of the .npz file of the endpoint histogram to add to (created if it does not exist).')
+
+    return p
+
+
+# lock a file next to the histogram so that runs finishing at the same time do not overwrite each
+# other, waiting until any other run has finished writing. the lock is released by the kernel if
+# the process dies, so a killed run never leaves a stale lock behind
+def acquire_lock(filename):
+    lock = open(filename + '.lock', 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+
+    return lock
+
+
+def release_lock(lock):
+    fcntl.flock(lock, fcntl.LOCK_UN)
+    lock.close()
+
+
+def main():
+    parser = _build_args_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # make sure the input files exist
+    if not isfile(args.intersections):
+        parser.error('The file "{0}" must exist.'.format(args.intersections))
+
+    if not isfile(args.mesh):
+        parser.error('The file "{0}" must exist.'.format(args.mesh))
+
+    logging.info('Loading mapping and intersections.')
+
+    # only the shape of the full resolution mesh is needed
+    shape = np.load(args.mesh, allow_pickle=True)['shape']
+
+    # load intersections that have already been snapped to nearest vertices of full mesh
+    intersections = np.load(args.intersections, allow_pickle=True)
+    id_in, id_out, _ = load_endpoints(intersections, shape)
+
+    logging.info('Calculating endpoint histogram for ' + str(len(id_in)) + ' streamlines.')
+
+    histogram = endpoint_histogram(id_in, id_out, shape[3])
+
+    lock = acquire_lock(args.histogram)
+
+    try:
+        runs = np.array([], dtype=np.int64)
+
+        # add to the existing histogram, making sure a run is never counted twice
+        if isfile(args.histogram):
+            accumulator = np.load(args.histogram)
+
+            # histograms from calculate_endpoint_histogram.py (or save_npz) do not record their runs
+            if 'runs' in accumulator.files:
+                runs = accumulator['runs']
+            else:
+                logging.warning('"{0}" does not record its runs, assuming it does not contain run {1}.'.format(args.histogram, args.run))
+
+            if args.run in runs:
+                logging.warning('Run {0} is already in "{1}", skipping.'.format(args.run, args.histogram))
+                return
+
+            histogram = histogram + sparse.load_npz(args.histogram)
+
+        runs = np.sort(np.append(runs, args.run))
+
+        logging.info('Saving histogram with runs: ' + ', '.join([str(run) for run in runs]) + '.')
+
+        # write to a temporary file first so the histogram is never left half written
+        histogram = histogram.tocsr()
+        tmp_file = args.histogram + '.tmp'
+
+        with open(tmp_file, 'wb') as outfile:
+            np.savez_compressed(outfile,
+                                format=b'csr',
+                                shape=histogram.shape,
+                                data=histogram.data,
+                                indices=histogram.indices,
+                                indptr=histogram.indptr,
+                                runs=runs)
+
+        os.rename(tmp_file, args.histogram)
+    finally:
+        release_lock(lock)
+
+
+if __name__ == "__main__":
+    main()
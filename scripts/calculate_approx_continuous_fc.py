@@ -4,10 +4,13 @@ import nibabel as nib
 import numpy as np
 import scipy.io as scio
 
-from os.path import isfile
+from os.path import isfile, isdir
+from connectivity import load_averaging_matrix, normalise_rows, load_fc_factors, roi_weights, load_time_series
 
 DESCRIPTION = """
-  Calculate the continuous functional connectivity (using Pearson Correlation) to an atlas from the given mapping.
+  Calculate the continuous functional connectivity (using Pearson Correlation) to one or more atlases from the given mapping.
+  The vertex x vertex correlations are calculated once, in blocks of rows, and the area weighted Fisher
+  z-transformed sums of every atlas are accumulated from each block.
 """
 
 
@@ -15,20 +18,39 @@ def _build_args_parser():
     p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
                                 description=DESCRIPTION)
 
-    p.add_argument('--time_series', action='store', metavar='LH_TIME_SERIES', required=True,
-                   type=str, help='Path of the .npz file containing functional time series.')
+    source = p.add_mutually_exclusive_group(required=True)
+
+    source.add_argument('--time_series', action='store', metavar='TIME_SERIES',
+                        type=str, help='Path of the .npz file (or directory of .npy files) containing functional time series.')
+
+    source.add_argument('--fc_factors', action='store', metavar='FC_FACTORS',
+                        type=str, help='Path of the .npz file of normalised time series (output of calculate_fc.py --low_rank).')
 
     p.add_argument('--mesh', action='store', metavar='MESH', required=True,
                    type=str, help='Path to the mapping for the resolution of the surfaces (.npz).')
 
-    p.add_argument('--atlas', action='store', metavar='ATLAS', required=True,
-                   type=str, help='Path to the atlas for the resolution of the surfaces (.npz).')
+    p.add_argument('--areas', action='store', metavar='AREAS', default=None,
+                   type=str, help='If set, path of the .npy file of full resolution vertex areas (output of\n' +
+                                  'calculate_vertex_areas.py), to average the time series weighted by area instead of by count.')
+
+    p.add_argument('--atlas', action='store', metavar='ATLAS', required=True, nargs='+',
+                   type=str, help='Path to the atlases for the resolution of the surfaces (.npz).')
+
+    p.add_argument('--output', action='store', metavar='OUTPUT', required=True, nargs='+',
+                   type=str, help='Path of the .mat file to save the output of each atlas to.')
 
-    p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
-                   type=str, help='Path of the .npz file to save the output to.')
+    p.add_argument('--mask_indices', type=int, nargs='+', action='append', default=None,
+                   help='List of freesurfer label indices to ignore when calculating connectivity.\n' +
+                        'Given once for all atlases, or once for each atlas (in the same order).')
 
-    p.add_argument('--mask_indices', type=int, nargs='+', default=[-1],
-                   help='List of freesurfer label indices to ignore when calculating connectivity.')
+    p.add_argument('--block_size', action='store', metavar='BLOCK_SIZE', default=1000,
+                   type=int, help='Number of vertices to correlate with all others at a time.')
+
+    p.add_argument('--float32', action='store_true', dest='float32',
+                   help='If set, calculate the correlations in single precision (the sums are accumulated in double precision).')
+
+    p.add_argument('--validate', action='store_true', dest='validate',
+                   help='If set (with --float32), also calculate the continuous FC in double precision and report the maximum deviation.')
 
     p.add_argument('-f', action='store_true', dest='overwrite',
                    help='If set, overwrite files if they already exist.')
@@ -36,104 +58,136 @@ def _build_args_parser():
     return p
 
 
+# area weighted average Fisher z-transformed FC (upper triangle) between the rois of each atlas, given
+# as sparse (vertex x roi) weights, with the vertex x vertex correlations calculated in blocks of rows
+def continuous_fc(Z, weights, block_size):
+    sums = [np.zeros([w.shape[1], w.shape[1]], dtype=np.float64) for w in weights]
+
+    # in the unlikely case of perfect correlation, atanh is not defined (1 - 1e-15 is 1 in single precision)
+    limit = 1 - max(1e-15, np.finfo(Z.dtype).eps)
+
+    for start in range(0, Z.shape[0], block_size):
+        stop = min(start + block_size, Z.shape[0])
+
+        corr = Z[start:stop].dot(Z.T)
+
+        np.clip(corr, -limit, limit, out=corr)
+        np.arctanh(corr, out=corr)
+
+        # area weighted sums over the rois of each atlas (the double precision weights
+        # mean that the sums are accumulated in double precision)
+        for w, roi_sums in zip(weights, sums):
+            roi_sums += w[start:stop].T.dot(w.T.dot(corr.T).T)
+
+    results = []
+
+    for w, roi_sums in zip(weights, sums):
+        total = np.asarray(w.sum(axis=0)).ravel()
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = np.triu(np.tanh(roi_sums / np.outer(total, total)), 1)
+
+        # replace all nans with 0s
+        results.append(np.nan_to_num(result))
+
+    return results
+
+
 def main():
     parser = _build_args_parser()
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
 
     # make sure the input files exist
-    if not isfile(args.time_series):
-        parser.error('The file "{0}" must exist.'.format(args.time_series))
+    source = args.time_series if args.time_series is not None else args.fc_factors
+
+    if not (isfile(source) or isdir(source)):
+        parser.error('The file "{0}" must exist.'.format(source))
 
     if not isfile(args.mesh):
         parser.error('The file "{0}" must exist.'.format(args.mesh))
 
-    if not isfile(args.atlas):
-        parser.error('The file "{0}" must exist.'.format(args.atlas))
+    if args.areas is not None and not isfile(args.areas):
+        parser.error('The file "{0}" must exist.'.format(args.areas))
 
-    # make sure files are not accidently overwritten
-    if isfile(args.output):
-        if args.overwrite:
-            logging.info('Overwriting "{0}".'.format(args.output))
-        else:
-            parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
+    for atlas in args.atlas:
+        if not isfile(atlas):
+            parser.error('The file "{0}" must exist.'.format(atlas))
 
-    # load mapping
-    mesh = np.load(args.mesh, allow_pickle=True)
-    mapping = mesh['mapping']
-    shape = mesh['shape']
+    if not len(args.atlas) == len(args.output):
+        parser.error('An output must be given for each atlas.')
 
-    # load atlas
-    atlas = np.load(args.atlas, allow_pickle=True)
-    mask = np.isin(atlas['fs_labels'], args.mask_indices, invert=True)
-    grouping = atlas['sbci_labels']
+    if args.mask_indices is None:
+        args.mask_indices = [[-1]]
 
-    rois = np.unique(grouping[mask])
-    n = len(rois)
+    if len(args.mask_indices) == 1:
+        args.mask_indices = args.mask_indices * len(args.atlas)
+    elif not len(args.mask_indices) == len(args.atlas):
+        parser.error('--mask_indices must be given once, or once for each atlas.')
 
-    # load time series for left and right hemispheres
-    logging.info('Loading timeseries data.')
+    # make sure files are not accidently overwritten
+    for output in args.output:
+        if isfile(output):
+            if args.overwrite:
+                logging.info('Overwriting "{0}".'.format(output))
+            else:
+                parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(output))
 
-    time_series_data = np.load(args.time_series)
-    time_series_data = np.concatenate((time_series_data['lh_time_series'], time_series_data['rh_time_series']))
+    if args.validate and not args.float32:
+        parser.error('--validate compares single to double precision, and requires --float32.')
 
-    # initialise an array to fill in the loop
-    mean_time_series = np.empty([shape[0], time_series_data.shape[1]], dtype=np.float64)
-    areas = np.empty(shape[0])
+    # load mapping
+    mesh = np.load(args.mesh, allow_pickle=True)
+    mapping = mesh['mapping']
 
-    # calculate mean signal at each 
-    # vertex given the current mapping
-    for i in range(shape[0]):
-        vertex = mapping[i]
-        mean_time_series[i, :] = np.mean(time_series_data[vertex, :], axis=0)
-        areas[i] = len(mapping[i])
+    areas = np.array([len(vertices) for vertices in mapping], dtype=np.float64)
 
-    n = len(rois)
+    # load atlases
+    weights = []
 
-    logging.info('Mean TS length:' + str(mean_time_series.shape[0]))
-    logging.info('Calculating signal for ' + str(n) + ' rois.')
+    for atlas_file, mask_indices in zip(args.atlas, args.mask_indices):
+        atlas = np.load(atlas_file, allow_pickle=True)
+        mask = np.isin(atlas['fs_labels'], mask_indices, invert=True)
+        grouping = atlas['sbci_labels']
 
-    # initialise an array to fill in the loop
-    result = np.zeros([n, n], dtype=np.float64)
+        rois = np.unique(grouping[mask])
+        weights.append(roi_weights(grouping, rois, areas))
 
-    logging.info('Calculating FC.')
+    logging.info('Calculating signal for ' + ', '.join([str(w.shape[1]) for w in weights]) + ' rois.')
+
+    if args.fc_factors is not None:
+        Z, _ = load_fc_factors(args.fc_factors)
+    else:
+        # load time series for left and right hemispheres
+        logging.info('Loading timeseries data.')
 
-    # calculate continuous fc a each given roi in the current mapping
-    for i in range(n):
-        mask = (grouping == rois[i])
-        roi_a = mean_time_series[mask, :]
-        area_a = areas[mask]
+        time_series_data = load_time_series(args.time_series)
+        time_series_data = np.concatenate((time_series_data['lh_time_series'], time_series_data['rh_time_series']))
 
-        X_mX = roi_a - roi_a.mean(axis=1).reshape((-1, 1))
-        ssX = (X_mX**2).sum(axis=1).reshape((-1, 1))
+        # calculate mean signal at each vertex given the current mapping
+        mean_time_series = load_averaging_matrix(args.mesh, areas=args.areas).dot(time_series_data)
 
-        for j in range(i, n):
-            if i == j:
-                result[i, j] = 0
-                continue
+        logging.info('Mean TS length:' + str(mean_time_series.shape[0]))
 
-            mask = (grouping == rois[j])
-            roi_b = mean_time_series[mask, :]
-            area_b = areas[mask]
+        # vertices without a signal correlate 0 with all others, but their area is still counted
+        Z = normalise_rows(mean_time_series)
 
-            area_ab = area_a.reshape(-1,1) * area_b.reshape(1,-1)
+    dtype = np.float32 if args.float32 else np.float64
 
-            Y_mY = roi_b - roi_b.mean(axis=1).reshape((-1, 1))
-            ssY = (Y_mY**2).sum(axis=1).reshape((1, -1))
+    logging.info('Calculating FC.')
 
-            corr = np.dot(X_mX, Y_mY.T) / np.sqrt(np.dot(ssX, ssY))
+    results = continuous_fc(Z.astype(dtype, copy=False), weights, args.block_size)
 
-            # in the unlikely case of perfect correlation, atanh is not defined
-            fisher_corr = np.arctanh(corr.clip(-1+1e-15,1-1e-15))
-            fisher_corr = np.nansum(fisher_corr * area_ab) / (sum(area_a) * sum(area_b))
-            result[i, j] = np.tanh(fisher_corr)
+    # compare to the continuous FC calculated in double precision
+    if args.validate:
+        logging.info('Calculating FC in double precision.')
 
-    # replace all nans with 0s
-    result = np.nan_to_num(result)
+        for result, reference, output in zip(results, continuous_fc(Z, weights, args.block_size), args.output):
+            logging.info('Maximum deviation of "{0}" from double precision: {1:.3g}'.format(output, np.abs(result - reference).max()))
 
     # save the results
-    scio.savemat(args.output, {'cfc': result})
-    #np.savez_compressed(args.output, fc=result)
+    for result, output in zip(results, args.output):
+        scio.savemat(output, {'cfc': result.astype(dtype)})
 
 
 if __name__ == "__main__":
@@ -5,10 +5,14 @@ import numpy as np
 
 import scipy.io as scio
 
-from os.path import isfile
+from os.path import isfile, isdir
+from connectivity import load_averaging_matrix, normalise_rows, load_fc_factors, fc_roi_average, roi_weights, \
+                         load_time_series
 
 DESCRIPTION = """
-  Calculate the functional connectivity (using Pearson Correlation) for the given mapping.
+  Calculate the functional connectivity (using Pearson Correlation) to an atlas from the given mapping, as the
+  area weighted average of the FC between all pairs of vertices of each pair of ROIs. This is calculated from the
+  normalised time series of the ROIs, so the vertex x vertex FC is never formed.
 """
 
 
@@ -16,12 +20,21 @@ def _build_args_parser():
     p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
                                 description=DESCRIPTION)
 
-    p.add_argument('--time_series', action='store', metavar='LH_TIME_SERIES', required=True,
-                   type=str, help='Path of the .npz file containing functional time series.')
+    source = p.add_mutually_exclusive_group(required=True)
+
+    source.add_argument('--time_series', action='store', metavar='TIME_SERIES',
+                        type=str, help='Path of the .npz file (or directory of .npy files) containing functional time series.')
+
+    source.add_argument('--fc_factors', action='store', metavar='FC_FACTORS',
+                        type=str, help='Path of the .npz file of normalised time series (output of calculate_fc.py --low_rank).')
 
     p.add_argument('--mesh', action='store', metavar='MESH', required=True,
                    type=str, help='Path to the mapping for the resolution of the surfaces (.npz).')
 
+    p.add_argument('--areas', action='store', metavar='AREAS', default=None,
+                   type=str, help='If set, path of the .npy file of full resolution vertex areas (output of\n' +
+                                  'calculate_vertex_areas.py), to average the time series weighted by area instead of by count.')
+
     p.add_argument('--atlas', action='store', metavar='ATLAS', required=True,
                    type=str, help='Path to the atlas for the resolution of the surfaces (.npz).')
 
@@ -37,29 +50,23 @@ def _build_args_parser():
     return p
 
 
-# calculate the 2D (vector) Pearson correlation
-def corr2(X, Y):
-    X_mX = X - X.mean(axis=1).reshape((-1, 1))
-    Y_mY = Y - Y.mean(axis=1).reshape((-1, 1))
-
-    ssX = (X_mX**2).sum(axis=1).reshape((-1, 1))
-    ssY = (Y_mY**2).sum(axis=1).reshape((1, -1))
-
-    return np.dot(X_mX, Y_mY.T) / np.sqrt(np.dot(ssX, ssY))
-
-
 def main():
     parser = _build_args_parser()
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
 
     # make sure the input files exist
-    if not isfile(args.time_series):
-        parser.error('The file "{0}" must exist.'.format(args.time_series))
+    source = args.time_series if args.time_series is not None else args.fc_factors
+
+    if not (isfile(source) or isdir(source)):
+        parser.error('The file "{0}" must exist.'.format(source))
 
     if not isfile(args.mesh):
         parser.error('The file "{0}" must exist.'.format(args.mesh))
 
+    if args.areas is not None and not isfile(args.areas):
+        parser.error('The file "{0}" must exist.'.format(args.areas))
+
     if not isfile(args.atlas):
         parser.error('The file "{0}" must exist.'.format(args.atlas))
 
@@ -83,45 +90,26 @@ def main():
     rois = np.unique(grouping[mask])
     n = len(rois)
 
-    logging.info('Loading timeseries data.')
-
-    # load time series for left and right hemispheres
-    time_series_data = np.load(args.time_series)
-    time_series_data = np.concatenate((time_series_data['lh_time_series'], time_series_data['rh_time_series']))
-
-    logging.info('TS length:' + str(time_series_data.shape))
-    logging.info('Calculating mean signal for ' + str(shape[0]) + ' vertices.')
-
-    # initialise an array to fill in the loop
-    mean_time_series = np.empty([shape[0], time_series_data.shape[1]], dtype=np.float64)
-
-    # calculate mean signal at each 
-    # vertice given the current mapping
-    for i in range(shape[0]):
-        vertex = mapping[i]
-        mean_time_series[i, :] = np.mean(time_series_data[vertex, :], axis=0)
-
-    n = len(rois)
+    if args.fc_factors is not None:
+        Z, _ = load_fc_factors(args.fc_factors)
+    else:
+        logging.info('Loading timeseries data.')
 
-    # initialise an array to fill in the loop
-    result = np.zeros([n, n], dtype=np.float64)
+        # load time series for left and right hemispheres
+        time_series_data = load_time_series(args.time_series)
+        time_series_data = np.concatenate((time_series_data['lh_time_series'], time_series_data['rh_time_series']))
 
-    logging.info('Calculating FC.')
+        logging.info('TS length:' + str(time_series_data.shape))
+        logging.info('Calculating mean signal for ' + str(shape[0]) + ' vertices.')
 
-    # calculate fc a each given roi in the current mapping
-    for i in range(n):
-        mask = (grouping == rois[i])
-        roi_a = mean_time_series[mask, :]
+        # calculate mean signal at each vertex given the current mapping
+        Z = normalise_rows(load_averaging_matrix(args.mesh, areas=args.areas).dot(time_series_data))
 
-        for j in range(i, n):
-            if i == j:
-                result[i, j] = 0
-                continue
+    logging.info('Calculating FC for ' + str(n) + ' rois.')
 
-            mask = (grouping == rois[j])
-            roi_b = mean_time_series[mask, :]
+    areas = np.array([len(vertices) for vertices in mapping], dtype=np.float64)
 
-            result[i, j] = corr2(roi_a, roi_b)
+    result = np.triu(np.nan_to_num(fc_roi_average(Z, roi_weights(grouping, rois, areas))), 1)
 
     # save the results
     scio.savemat(args.output, {'fc': result})
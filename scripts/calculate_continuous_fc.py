@@ -4,10 +4,14 @@ import nibabel as nib
 import numpy as np
 import scipy.io as scio
 
-from os.path import isfile
+from multiprocessing import Pool
+from os.path import isfile, isdir
+from connectivity import normalise_rows, load_time_series
 
 DESCRIPTION = """
   Calculate the continuous functional connectivity (using Pearson Correlation) for the given mapping.
+  The continuous FC between two downsampled vertices is the average Fisher z-transformed correlation
+  between all pairs of full resolution vertices mapped to them, calculated in blocks of rows.
 """
 
 
@@ -16,7 +20,7 @@ def _build_args_parser():
                                 description=DESCRIPTION)
 
     p.add_argument('--time_series', action='store', metavar='LH_TIME_SERIES', required=True,
-                   type=str, help='Path of the .npz file containing functional time series.')
+                   type=str, help='Path of the .npz file (or directory of .npy files) containing functional time series.')
 
     p.add_argument('--mesh', action='store', metavar='MESH', required=True,
                    type=str, help='Path to the mapping for the resolution of the surfaces (.npz).')
@@ -24,19 +28,102 @@ def _build_args_parser():
     p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
                    type=str, help='Path of the .npz file to save the output to.')
 
+    p.add_argument('--block_size', action='store', metavar='BLOCK_SIZE', default=200,
+                   type=int, help='Number of full resolution vertices to correlate with all others at a time. Each\n' +
+                                  'process holds a block of correlations (block size x full resolution vertices),\n' +
+                                  'about 0.5 GB in double precision for the default and fsaverage.')
+
+    p.add_argument('--memory', action='store', metavar='MEMORY', default=None,
+                   type=float, help='Memory budget (in MB) for the blocks of all processes together, overrides --block_size.')
+
+    p.add_argument('--float32', action='store_true', dest='float32',
+                   help='If set, calculate the correlations in single precision (the sums are accumulated in double precision).')
+
+    p.add_argument('--validate', action='store_true', dest='validate',
+                   help='If set (with --float32), also calculate the continuous FC in double precision and report the maximum deviation.')
+
+    p.add_argument('--processes', action='store', metavar='PROCESSES', required=False, default=1,
+                   type=int, help='Number of processes to calculate blocks of rows in parallel.')
+
     p.add_argument('-f', action='store_true', dest='overwrite',
                    help='If set, overwrite files if they already exist.')
 
     return p
 
 
+# normalised full resolution time series (ordered by downsampled vertex) with the
+# downsampled vertex of each row and the first row of each downsampled vertex
+_shared = {}
+
+
+def _init_shared(Z, labels, starts):
+    _shared['Z'] = Z
+    _shared['labels'] = labels
+    _shared['starts'] = starts
+
+
+# sum of the Fisher z-transformed correlations between a block of full resolution vertices and
+# all following vertices, reduced over the downsampled vertices of the rows and columns
+def fisher_block_sums(block):
+    start, stop = block
+    Z = _shared['Z']
+    labels = _shared['labels']
+    starts = _shared['starts']
+
+    first = labels[start]
+    last = labels[stop - 1]
+
+    # only the upper triangle is needed, so start from the first row of the block's first vertex
+    corr = Z[start:stop].dot(Z[starts[first]:].T)
+
+    # in the unlikely case of perfect correlation, atanh is not defined (1 - 1e-12 is 1 in single precision)
+    limit = 1 - max(1e-12, np.finfo(corr.dtype).eps)
+    np.clip(corr, -limit, limit, out=corr)
+    np.arctanh(corr, out=corr)
+
+    # segment sums over the columns (accumulated in double precision), then over the rows, of each downsampled vertex
+    corr = np.add.reduceat(corr, starts[first:-1] - starts[first], axis=1, dtype=np.float64)
+    corr = np.add.reduceat(corr, np.maximum(starts[first:last+1] - start, 0), axis=0)
+
+    return first, corr
+
+
+# continuous FC (upper triangle) between the downsampled vertices, from the normalised full resolution
+# time series ordered by downsampled vertex, and the number of valid full resolution vertices of each
+def continuous_fc(Z, labels, starts, counts, block_size, processes=1):
+    n = len(counts)
+    blocks = [(start, min(start + block_size, len(labels))) for start in range(0, len(labels), block_size)]
+
+    result = np.zeros([n, n], dtype=np.float64)
+
+    if processes > 1:
+        pool = Pool(processes, _init_shared, (Z, labels, starts))
+        sums = pool.imap_unordered(fisher_block_sums, blocks)
+    else:
+        _init_shared(Z, labels, starts)
+        sums = (fisher_block_sums(block) for block in blocks)
+
+    for first, block_sums in sums:
+        result[first:first + block_sums.shape[0], first:] += block_sums
+
+    if processes > 1:
+        pool.close()
+
+    # average over all pairs of full resolution vertices, keeping the upper triangle
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.triu(np.tanh(result / np.outer(counts, counts)), 1)
+
+    # remove all NaNs and set to 0
+    return np.nan_to_num(result)
+
+
 def main():
     parser = _build_args_parser()
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
 
     # make sure the input files exist
-    if not isfile(args.time_series):
+    if not (isfile(args.time_series) or isdir(args.time_series)):
         parser.error('The file "{0}" must exist.'.format(args.time_series))
 
     if not isfile(args.mesh):
@@ -49,6 +136,9 @@ def main():
         else:
             parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
 
+    if args.validate and not args.float32:
+        parser.error('--validate compares single to double precision, and requires --float32.')
+
     # load mapping
     mesh = np.load(args.mesh, allow_pickle=True)
     mapping = mesh['mapping']
@@ -57,48 +147,58 @@ def main():
     # load time series for left and right hemispheres
     logging.info('Loading timeseries data.')
 
-    time_series_data = np.load(args.time_series)
+    time_series_data = load_time_series(args.time_series)
     time_series_data = np.concatenate((time_series_data['lh_time_series'], time_series_data['rh_time_series']))
 
     logging.info('TS length:' + str(time_series_data.shape))
     logging.info('Calculating signal for ' + str(shape[0]) + ' vertices.')
 
-    # initialise an array to fill in the loop
-    result = np.zeros([shape[0], shape[0]], dtype=np.float64)
-
     logging.info('Calculating FC.')
 
-    # calculate continuous fc a each given roi in the current mapping
-    for i in range(shape[0]):
-        roi_a = time_series_data[mapping[i], :]
-        roi_a = roi_a[~np.all(roi_a == 0, axis=1)]
+    n = shape[0]
+    sizes = np.array([len(vertices) for vertices in mapping], dtype=np.int64)
+    vertices = np.concatenate(mapping).astype(np.int64)
+    labels = np.repeat(np.arange(n), sizes)
 
-        X_mX = roi_a - roi_a.mean(axis=1).reshape((-1, 1))
-        ssX = (X_mX**2).sum(axis=1).reshape((-1, 1))
-        
-        for j in range(i, shape[0]):
-            if i == j:
-                result[i, j] = 0
-                continue
+    # vertices without a signal (all zeros or constant) are not included in the average
+    Z = normalise_rows(time_series_data[vertices].astype(np.float32 if args.float32 else np.float64))
+    valid = np.any(Z != 0, axis=1)
 
-            roi_b = time_series_data[mapping[j], :]
-            roi_b = roi_b[~np.all(roi_b == 0, axis=1)]
+    labels = labels[valid]
+    counts = np.bincount(labels, minlength=n).astype(np.float64)
 
-            Y_mY = roi_b - roi_b.mean(axis=1).reshape((-1, 1))
-            ssY = (Y_mY**2).sum(axis=1).reshape((1, -1))
+    # downsampled vertices without any valid vertex keep an empty segment, which reduceat
+    # does not handle, so they are given a single row of zeros that is not counted
+    empty = np.flatnonzero(counts == 0)
+    positions = np.searchsorted(labels, empty)
 
-            corr = np.dot(X_mX, Y_mY.T) / np.sqrt(np.dot(ssX, ssY))
+    Z = np.insert(Z[valid], positions, 0, axis=0)
+    labels = np.insert(labels, positions, empty)
 
-            # in the unlikely case of perfect correlation, atanh is not defined
-            clipped_cor = corr.clip(-1+1e-12,1-1e-12)
+    starts = np.append(np.searchsorted(labels, np.arange(n)), len(labels))
 
-            result[i, j] = np.tanh(np.mean(np.arctanh(clipped_cor)))
+    block_size = args.block_size
 
-    # remove all NaNs and set to 0
-    result = np.nan_to_num(result)
+    # each process holds a block of correlations and its sums over the downsampled vertices in double precision
+    if args.memory is not None:
+        row_bytes = len(labels) * Z.dtype.itemsize + n * np.dtype(np.float64).itemsize
+        block_size = max(1, int(args.memory * 1024**2 / (args.processes * row_bytes)))
+
+    logging.info('Calculating FC {0} full resolution vertices at a time.'.format(block_size))
+
+    result = continuous_fc(Z, labels, starts, counts, block_size, args.processes)
+
+    # compare to the continuous FC calculated in double precision (from the same valid vertices)
+    if args.validate:
+        logging.info('Calculating FC in double precision.')
+
+        Z = np.insert(normalise_rows(time_series_data[vertices])[valid], positions, 0, axis=0)
+        reference = continuous_fc(Z, labels, starts, counts, block_size, args.processes)
+
+        logging.info('Maximum deviation of FC from double precision: {0:.3g}'.format(np.abs(result - reference).max()))
 
     # save the results
-    scio.savemat(args.output, {'cfc': result})
+    scio.savemat(args.output, {'cfc': result.astype(np.float32) if args.float32 else result})
 
 
 if __name__ == "__main__":
@@ -2,12 +2,17 @@ import argparse
 import logging
 import numpy as np
 import vtk
+import vtk.util.numpy_support as ns
 
 from scipy import sparse
+from scipy.spatial import cKDTree
 from os.path import isfile
+from connectivity import mapping_matrix, load_endpoints, endpoint_histogram, aggregate_histogram
 
 DESCRIPTION = """
-  Calculate the density of fiber count within a radius of each vertex on the surface.
+  Calculate the density of fiber count within a radius of each vertex on the surface. The
+  endpoint counts come from the full resolution endpoint histogram (given, or built from the
+  intersections), aggregated to the resolution of the mesh.
 """
 
 
@@ -21,14 +26,20 @@ def _build_args_parser():
     p.add_argument('--rh_surface', action='store', metavar='RH_SURFACE', required=True,
                    type=str, help='Path to the RH surface .vtk file to use.')
 
-    p.add_argument('--intersections', action='store', metavar='INTERSECTIONS', required=True,
-                   type=str, help='Path to the .npz file of intersections that have been snapped to nearest vertices.')
+    source = p.add_mutually_exclusive_group(required=True)
+
+    source.add_argument('--intersections', action='store', metavar='INTERSECTIONS',
+                        type=str, help='Path to the .npz file of intersections that have been snapped to nearest vertices.')
+
+    source.add_argument('--histogram', action='store', metavar='HISTOGRAM',
+                        type=str, help='Path of the .npz file of the full resolution endpoint histogram\n' +
+                                       '(output of calculate_endpoint_histogram.py).')
 
     p.add_argument('--mesh', action='store', metavar='MESH', required=True,
                    type=str, help='Path to the mapping for the resolution of the surfacecs (.npz).')
 
-    p.add_argument('--epsilon', action='store', metavar='EPSILON', required=True,
-                   type=float, help='Radius for epsilon ball density calculation.')
+    p.add_argument('--epsilon', type=float, nargs='+', required=True,
+                   help='List of radii for epsilon ball density calculation.')
 
     p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
                    type=str, help='Path of the .npz file to output.')
@@ -48,21 +59,42 @@ def load_vtk(filename):
     return reader.GetOutput()
 
 
-# load all the required surfaces and build locator algorithms
+# load all the required surfaces and extract their vertices
 def initialise_surfaces(surface_files):
     surfaces = dict()
-    locators = dict()
+    points = dict()
 
     for i, filename in enumerate(surface_files):
         surfaces[i] = load_vtk(filename)
+        points[i] = ns.vtk_to_numpy(surfaces[i].GetPoints().GetData()).astype(np.double)
+
+    return surfaces, points
+
+
+# build a sparse graph of all pairs of points within radius of each other (including each point
+# with itself), storing the distance between them so that smaller radii can be filtered from it
+def radius_graph(points, radius):
+    tree = cKDTree(points)
+    pairs = tree.sparse_distance_matrix(tree, radius, output_type='coo_matrix')
+
+    # recalculate distances so that zero distances are not lost, and add the diagonal explicitly
+    mask = ~(pairs.row == pairs.col)
+    row = np.concatenate([pairs.row[mask], np.arange(points.shape[0])])
+    col = np.concatenate([pairs.col[mask], np.arange(points.shape[0])])
+    dist = np.linalg.norm(points[row] - points[col], axis=1)
 
-        # point locators are used to quickly 
-        # search for points on a given surface
-        locators[i] = vtk.vtkPointLocator()
-        locators[i].SetDataSet(surfaces[i])
-        locators[i].BuildLocator()
+    return sparse.coo_matrix((dist, (row, col)), shape=(points.shape[0], points.shape[0]))
 
-    return surfaces, locators
+
+# number of streamline endpoints at each downsampled vertex from the full resolution endpoint
+# histogram, counting self connections (both endpoints in the same downsampled vertex) once. the
+# row sums count those streamlines twice if their endpoints are different full resolution vertices,
+# which is half of what the diagonal of the aggregated histogram adds to the full resolution diagonal
+def endpoint_counts(histogram, mapping_mat):
+    counts = mapping_mat.T.dot(np.asarray(histogram.sum(axis=1)).ravel())
+    doubled = aggregate_histogram(histogram, mapping_mat).diagonal() - mapping_mat.T.dot(histogram.diagonal())
+
+    return counts - doubled / 2
 
 
 def main():
@@ -77,9 +109,12 @@ def main():
     if not isfile(args.rh_surface):
         parser.error('The file "{0}" must exist.'.format(args.rh_surface))
 
-    if not isfile(args.intersections):
+    if args.intersections is not None and not isfile(args.intersections):
         parser.error('The file "{0}" must exist.'.format(args.intersections))
 
+    if args.histogram is not None and not isfile(args.histogram):
+        parser.error('The file "{0}" must exist.'.format(args.histogram))
+
     if not isfile(args.mesh):
         parser.error('The file "{0}" must exist.'.format(args.mesh))
 
@@ -90,87 +125,56 @@ def main():
         else:
             parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
 
-    # load the surfaces and initialise cell locator algorithms
-    logging.info('Loading .vtk surfaces, mapping, and intersections.')
+    # load the surfaces and their vertices
+    logging.info('Loading .vtk surfaces, mapping, and endpoints.')
 
-    surfaces, locators = initialise_surfaces([args.lh_surface, args.rh_surface])
+    surfaces, points = initialise_surfaces([args.lh_surface, args.rh_surface])
 
     # load the mapping
     mesh = np.load(args.mesh, allow_pickle=True)
 
-    mapping = mesh['mapping']
     shape = mesh['shape']
 
-    # load the intersections that have already been snapped to nearest vertices of full mesh
-    intersections = np.load(args.intersections, allow_pickle=True)
-
-    # triangle indices
-    lh_limit = surfaces[0].GetNumberOfCells() - 1
-    rh_limit = surfaces[0].GetNumberOfCells() + surfaces[1].GetNumberOfCells() - 1
-
-    tri_ids0 = intersections['tri_ids0'].astype(np.int64)
-    tri_ids1 = intersections['tri_ids1'].astype(np.int64)
-    pts0 = intersections['v_ids0'].astype(np.int64)
-    pts1 = intersections['v_ids1'].astype(np.int64)
+    if args.histogram is not None:
+        histogram = sparse.load_npz(args.histogram)
+    else:
+        # load the intersections that have already been snapped to nearest vertices of full mesh
+        intersections = np.load(args.intersections, allow_pickle=True)
+        id_in, id_out, _ = load_endpoints(intersections, shape)
 
-    # only keep the white matter surfaces from the intersections 
-    # file and map rh vertex ids to the full brain indices
-    rh_surface_mask_in = (tri_ids0 > lh_limit) & (tri_ids0 <= rh_limit)
-    rh_surface_mask_out = (tri_ids1 > lh_limit) & (tri_ids1 <= rh_limit)
+        histogram = endpoint_histogram(id_in, id_out, shape[3])
 
-    id_in[rh_surface_mask_in] = id_in[rh_surface_mask_in] + shape[4]
-    id_out[rh_surface_mask_out] = id_out[rh_surface_mask_out] + shape[4]
+    # calculate the number of streamline endpoints at each vertex
+    counts = endpoint_counts(histogram, mapping_matrix(mesh['mapping'], shape))
 
-    surface_mask = (tri_ids0 <= rh_limit) & (tri_ids1 <= rh_limit)
-
-    pts0 = id_in[surface_mask]
-    pts1 = id_out[surface_mask]
-
-    # prepare vairables for the loop
-    id_in_buf = pts0.copy()
-    id_out_buf = pts1.copy()
-
-    # map intersections to the lower resolution mesh
-    for i in range(shape[0]):
-        pts0[np.in1d(id_in_buf, mapping[i])] = i
-        pts1[np.in1d(id_out_buf, mapping[i])] = i
-
-    # calculate the number of streamline endpoints at each vertex, 
-    # using a mask so that self connections are only counted once.
-    mask = ~((pts0 - pts1) == 0)
-    pts1 = pts1[mask]
-
-    id_in = np.bincount(pts0)
-    id_out = np.bincount(pts1)
-
-    id_in = np.pad(id_in, (0, shape[0] - id_in.shape[0]), 'constant')
-    id_out = np.pad(id_out, (0, shape[0] - id_out.shape[0]), 'constant')
-
-    counts = id_in + id_out
-
-    logging.info('Calculating density with epsilon = ' + str(args.epsilon) + '.')
-
-    # prepare variables for density calculation
-    result = vtk.vtkIdList()
-    density = np.zeros(shape[0])
+    epsilons = np.sort(args.epsilon)
+    density = np.zeros((len(epsilons), shape[0]))
     offset = 0
 
-    # calculate epsilon ball density at each vertex
+    # calculate epsilon ball density at each vertex, building the neighbourhood graph of
+    # each surface once for the largest radius and filtering it for the smaller ones
     for i in range(len(surfaces)):
-	for j in xrange(surfaces[i].GetNumberOfPoints()):
-            current_pt = surfaces[i].GetPoint(j)
+        n = points[i].shape[0]
+        graph = radius_graph(points[i], epsilons[-1])
+        surface_counts = counts[offset:offset + n]
 
-            locators[i].FindPointsWithinRadius(args.epsilon, current_pt, result)
+        for k, epsilon in enumerate(epsilons):
+            logging.info('Calculating density with epsilon = ' + str(epsilon) + '.')
 
-            ids = np.array([result.GetId(x) for x in range(result.GetNumberOfIds())])
-            density[offset + j] = np.mean(counts[ids + offset])
+            mask = (graph.data <= epsilon)
+            ball = sparse.csr_matrix((np.ones(np.sum(mask)), (graph.row[mask], graph.col[mask])), shape=(n, n))
 
-        offset = offset + surfaces[i].GetNumberOfPoints()
+            density[k, offset:offset + n] = ball.dot(surface_counts) / np.asarray(ball.sum(axis=1)).ravel()
+
+        offset = offset + n
 
     logging.info('Saving results.')
 
     # save the results
-    np.savez_compressed(args.output, density=density)
+    if len(epsilons) == 1:
+        density = density[0]
+
+    np.savez_compressed(args.output, density=density, epsilon=epsilons)
 
 
 if __name__ == "__main__":
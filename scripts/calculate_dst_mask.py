@@ -2,8 +2,11 @@ import argparse
 import logging
 import numpy as np
 import vtk
+import vtk.util.numpy_support as ns
 
 from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
 from os.path import isfile
 
 DESCRIPTION = """
@@ -27,6 +30,17 @@ def _build_args_parser():
     p.add_argument('--epsilon', action='store', metavar='EPSILON', required=True,
                    type=float, help='Max radius for mask calculation.')
 
+    p.add_argument('--geodesic', action='store_true', dest='geodesic',
+                   help='If set, use the shortest path along the mesh edges instead of the euclidean\n' +
+                        'distance (only points on the same hemisphere are connected).')
+
+    p.add_argument('--block_size', action='store', metavar='BLOCK_SIZE', default=100,
+                   type=int, help='Number of vertices to search outwards from at a time when using --geodesic.')
+
+    p.add_argument('--memory', action='store', metavar='MEMORY', default=None,
+                   type=float, help='Memory budget (in MB) for the distances of each block of vertices when using\n' +
+                                    '--geodesic, overrides --block_size.')
+
     p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
                    type=str, help='Path of the .npz file to output.')
 
@@ -45,21 +59,66 @@ def load_vtk(filename):
     return reader.GetOutput()
 
 
-# load all the required surfaces and build locator algorithms
+# load all the required surfaces and extract their vertices and triangles
 def initialise_surfaces(surface_files):
     surfaces = dict()
-    locators = dict()
+    points = dict()
+    triangles = dict()
 
     for i, filename in enumerate(surface_files):
         surfaces[i] = load_vtk(filename)
+        points[i] = ns.vtk_to_numpy(surfaces[i].GetPoints().GetData()).astype(np.double)
+
+        polydata = ns.vtk_to_numpy(surfaces[i].GetPolys().GetData())
+        triangles[i] = np.vstack([polydata[1::4], polydata[2::4], polydata[3::4]]).T
+
+    return surfaces, points, triangles
+
+
+# all pairs of points within radius of each other (including each point with itself)
+def radius_pairs(points, radius):
+    tree = cKDTree(points)
+    pairs = tree.sparse_distance_matrix(tree, radius, output_type='coo_matrix')
+
+    mask = ~(pairs.row == pairs.col)
+    row = np.concatenate([pairs.row[mask], np.arange(points.shape[0])])
+    col = np.concatenate([pairs.col[mask], np.arange(points.shape[0])])
+
+    return row, col
+
+
+# all pairs of points within radius of each other along the edges of the mesh. geodesic
+# distances are never smaller than euclidean ones, so only euclidean neighbours are kept. dijkstra
+# returns a dense (block x vertices) array of distances, so a block must fit in the memory budget (MB)
+def geodesic_pairs(points, triangles, radius, block_size=100, memory=None):
+    n = points.shape[0]
 
-        # point locators are used to quickly 
-        # search for points on a given surface
-        locators[i] = vtk.vtkPointLocator()
-        locators[i].SetDataSet(surfaces[i])
-        locators[i].BuildLocator()
+    if memory is not None:
+        block_size = max(1, int(memory * 1024**2 / (n * np.dtype(np.float64).itemsize)))
 
-    return surfaces, locators
+    # unique edges of the mesh, weighted by their length
+    edges = np.vstack([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]])
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    lengths = np.linalg.norm(points[edges[:, 0]] - points[edges[:, 1]], axis=1)
+    graph = sparse.coo_matrix((lengths, (edges[:, 0], edges[:, 1])), shape=(n, n)).tocsr()
+
+    row, col = radius_pairs(points, radius)
+
+    order = np.argsort(row, kind='mergesort')
+    row = row[order]
+    col = col[order]
+
+    keep = np.zeros(len(row), dtype=bool)
+
+    # search outwards from a block of vertices at a time, up to the given radius
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        lo, hi = np.searchsorted(row, [start, stop])
+
+        dist = dijkstra(graph, directed=False, indices=np.arange(start, stop), limit=radius)
+        keep[lo:hi] = dist[row[lo:hi] - start, col[lo:hi]] <= radius
+
+    return row[keep], col[keep]
 
 
 def main():
@@ -84,10 +143,13 @@ def main():
         else:
             parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
 
-    # load the surfaces and initialise cell locator algorithms
+    if args.block_size < 1:
+        parser.error('--block_size must be at least 1.')
+
+    # load the surfaces and their vertices
     logging.info('Loading .vtk surfaces, mapping, and intersections.')
 
-    surfaces, locators = initialise_surfaces([args.lh_surface, args.rh_surface])
+    surfaces, points, triangles = initialise_surfaces([args.lh_surface, args.rh_surface])
 
     # load the mapping
     mesh = np.load(args.mesh, allow_pickle=True)
@@ -97,30 +159,20 @@ def main():
 
     logging.info('Calculating mask with epsilon = ' + str(args.epsilon) + '.')
 
-    # prepare variables for density calculation
-    result = vtk.vtkIdList()
-    density = np.zeros(shape[0])
-    offset = surfaces[0].GetNumberOfPoints()
-
-    mask_matrix = sparse.dok_matrix((shape[0], shape[0]), dtype=np.bool)
-
-    # calculate epsilon ball density at each vertex
-    for i in range(2):
-	for j in xrange(surfaces[i].GetNumberOfPoints()):
-            current_pt = surfaces[i].GetPoint(j)
-
-            locators[0].FindPointsWithinRadius(args.epsilon, current_pt, result)
-
-            ids = np.array([result.GetId(x) for x in range(result.GetNumberOfIds())])
-            mask_matrix[ids, j+(i*offset)] = True
-            mask_matrix[j+(i*offset), ids] = True
+    offset = points[0].shape[0]
 
-            locators[1].FindPointsWithinRadius(args.epsilon, current_pt, result)
+    if args.geodesic:
+        # there are no edges between hemispheres, so search each one separately
+        lh_row, lh_col = geodesic_pairs(points[0], triangles[0], args.epsilon, args.block_size, args.memory)
+        rh_row, rh_col = geodesic_pairs(points[1], triangles[1], args.epsilon, args.block_size, args.memory)
 
-            ids = np.array([result.GetId(x) for x in range(result.GetNumberOfIds())]) 
-            mask_matrix[ids+offset, j+(i*offset)] = True
-            mask_matrix[j+(i*offset), ids+offset] = True
+        row = np.concatenate([lh_row, rh_row + offset])
+        col = np.concatenate([lh_col, rh_col + offset])
+    else:
+        # search both hemispheres at once
+        row, col = radius_pairs(np.vstack([points[0], points[1]]), args.epsilon)
 
+    mask_matrix = sparse.coo_matrix((np.ones(len(row), dtype=bool), (row, col)), shape=(shape[0], shape[0]))
 
     logging.info('Saving results.')
 
@@ -0,0 +1,165 @@
+import argparse
+import h5py
+import logging
+import numpy as np
+
+from os.path import isfile, isdir
+from connectivity import load_averaging_matrix, load_time_series
+
+DESCRIPTION = """
+  Calculate the sliding window (dynamic) functional connectivity (using Pearson Correlation) for the given
+  mapping. The sums and cross-product sums of the window are updated as it slides (removing the time points
+  that leave the window and adding those that enter it), instead of calculating the FC of each window again.
+  The FC of each window is saved in the same upper triangular layout as calculate_fc.py, in the 'fc' dataset
+  (windows x vertices x vertices) of a chunked .h5 file, along with the first time point of each window.
+"""
+
+
+def _build_args_parser():
+    p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                description=DESCRIPTION)
+
+    p.add_argument('--time_series', action='store', metavar='TIME_SERIES', required=True,
+                   type=str, help='Path of the .npz file (or directory of .npy files) containing functional time series.')
+
+    p.add_argument('--mesh', action='store', metavar='MESH', required=True,
+                   type=str, help='Path to the mapping for the resolution of the surfaces (.npz).')
+
+    p.add_argument('--areas', action='store', metavar='AREAS', default=None,
+                   type=str, help='If set, path of the .npy file of full resolution vertex areas (output of\n' +
+                                  'calculate_vertex_areas.py), to average the time series weighted by area instead of by count.')
+
+    p.add_argument('--window', action='store', metavar='WINDOW', required=True,
+                   type=int, help='Number of time points in each window.')
+
+    p.add_argument('--step', action='store', metavar='STEP', required=False, default=1,
+                   type=int, help='Number of time points to slide the window by.')
+
+    p.add_argument('--refresh', action='store', metavar='REFRESH', required=False, default=100,
+                   type=int, help='Number of windows after which the sums are calculated again from scratch,\n' +
+                                  'to stop rounding errors from building up.')
+
+    p.add_argument('--float32', action='store_true', dest='float32',
+                   help='If set, save FC in single precision.')
+
+    p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
+                   type=str, help='Path of the .h5 file to save the output to.')
+
+    p.add_argument('-f', action='store_true', dest='overwrite',
+                   help='If set, overwrite files if they already exist.')
+
+    return p
+
+
+# upper triangular correlation matrix (ones on the diagonal) from the sum and cross-product sum of a window
+def window_correlation(sums, products, window):
+    covariance = products - np.outer(sums, sums) / window
+
+    # vertices without any variance in the window (up to rounding errors of the updates) are set to zero
+    variance = np.diag(covariance)
+    valid = variance > 1e-12 * variance.max()
+
+    scale = np.zeros(len(sums))
+    scale[valid] = 1.0 / np.sqrt(variance[valid])
+
+    corr = covariance * np.outer(scale, scale)
+
+    corr = np.triu(corr)
+    np.fill_diagonal(corr, 1)
+
+    return corr
+
+
+def main():
+    parser = _build_args_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # make sure the input files exist
+    if not (isfile(args.time_series) or isdir(args.time_series)):
+        parser.error('The file "{0}" must exist.'.format(args.time_series))
+
+    if not isfile(args.mesh):
+        parser.error('The file "{0}" must exist.'.format(args.mesh))
+
+    if args.areas is not None and not isfile(args.areas):
+        parser.error('The file "{0}" must exist.'.format(args.areas))
+
+    # make sure files are not accidently overwritten
+    if isfile(args.output):
+        if args.overwrite:
+            logging.info('Overwriting "{0}".'.format(args.output))
+        else:
+            parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
+
+    if args.window < 2:
+        parser.error('The window must have at least 2 time points.')
+
+    if args.step < 1:
+        parser.error('The step must be at least 1 time point.')
+
+    if args.refresh < 1:
+        parser.error('--refresh must be at least 1.')
+
+    logging.info('Loading timeseries data.')
+
+    # load time series for left and right hemispheres
+    full_time_series_data = load_time_series(args.time_series)
+    time_series_data = np.concatenate((full_time_series_data['lh_time_series'],
+                                       full_time_series_data['rh_time_series']))
+
+    # calculate mean signal at each vertex given the current mapping
+    mean_time_series = load_averaging_matrix(args.mesh, areas=args.areas).dot(time_series_data)
+
+    # remove the mean over the whole run, which reduces rounding errors in the sums
+    mean_time_series = mean_time_series - mean_time_series.mean(axis=1, keepdims=True)
+
+    n, length = mean_time_series.shape
+
+    if args.window > length:
+        parser.error('The window is longer than the time series ({0} time points).'.format(length))
+
+    starts = np.arange(0, length - args.window + 1, args.step)
+
+    logging.info('Calculating FC for {0} windows of {1} vertices.'.format(len(starts), n))
+
+    dtype = np.float32 if args.float32 else np.float64
+
+    h5_file = h5py.File(args.output, 'w')
+    h5_file.create_dataset('starts', data=starts)
+    h5_file.attrs['window'] = args.window
+    h5_file.attrs['step'] = args.step
+
+    chunks = (1, min(n, 256), min(n, 256))
+    fc_dataset = h5_file.create_dataset('fc', shape=(len(starts), n, n), dtype=dtype, chunks=chunks,
+                                        compression='gzip', compression_opts=1, fillvalue=0)
+
+    for i, start in enumerate(starts):
+        stop = start + args.window
+
+        # the update is a product over the time points that left and entered the window (2 x step),
+        # which is more work than a product over the window when the windows overlap by half or less
+        if i % args.refresh == 0 or 2 * args.step >= args.window:
+            # calculate the sums of the window from scratch
+            block = mean_time_series[:, start:stop]
+
+            sums = block.sum(axis=1)
+            products = block.dot(block.T)
+        else:
+            # slide the window, removing the time points that left it and adding the ones that entered it
+            previous = starts[i - 1]
+            leaving = mean_time_series[:, previous:min(start, previous + args.window)]
+            entering = mean_time_series[:, max(start, previous + args.window):stop]
+
+            sums += entering.sum(axis=1) - leaving.sum(axis=1)
+
+            # a single rank-k update, E E^T - L L^T = [E L] [E -L]^T
+            products += np.hstack([entering, leaving]).dot(np.hstack([entering, -leaving]).T)
+
+        fc_dataset[i] = window_correlation(sums, products, args.window).astype(dtype)
+
+    h5_file.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import logging
+
+import numpy as np
+
+from scipy import sparse
+from os.path import isfile
+from connectivity import load_endpoints, endpoint_histogram
+
+DESCRIPTION = """
+  Calculate the histogram of tract endpoint pairs on the full resolution surface. SC at any
+  resolution or atlas can then be calculated from it with calculate_sc.py --histogram.
+"""
+
+
+def _build_args_parser():
+    p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                description=DESCRIPTION)
+
+    p.add_argument('--intersections', action='store', metavar='INTERSECTIONS', required=True,
+                   type=str, help='Path of the .npz file of intersections that have been snapped to nearest vertices.')
+
+    p.add_argument('--mesh', action='store', metavar='MESH', required=True,
+                   type=str, help='Path to any downsampled mesh .npz file of the full resolution surface.')
+
+    p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
+                   type=str, help='Path of the .npz file of the endpoint histogram.')
+
+    p.add_argument('-f', action='store_true', dest='overwrite',
+                   help='If set, overwrite files if they already exist.')
+
+    return p
+
+
+def main():
+    parser = _build_args_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # make sure the input files exist
+    if not isfile(args.intersections):
+        parser.error('The file "{0}" must exist.'.format(args.intersections))
+
+    if not isfile(args.mesh):
+        parser.error('The file "{0}" must exist.'.format(args.mesh))
+
+    # make sure files are not accidently overwritten
+    if isfile(args.output):
+        if args.overwrite:
+            logging.info('Overwriting "{0}".'.format(args.output))
+        else:
+            parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
+
+    logging.info('Loading mapping and intersections.')
+
+    # only the shape of the full resolution mesh is needed
+    shape = np.load(args.mesh, allow_pickle=True)['shape']
+
+    # load intersections that have already been snapped to nearest vertices of full mesh
+    intersections = np.load(args.intersections, allow_pickle=True)
+    id_in, id_out, _ = load_endpoints(intersections, shape)
+
+    logging.info('Calculating endpoint histogram for ' + str(len(id_in)) + ' streamlines.')
+
+    histogram = endpoint_histogram(id_in, id_out, shape[3])
+
+    # save results
+    sparse.save_npz(args.output, histogram)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
 import argparse
+import h5py
 import logging
 import nibabel as nib
 import numpy as np
 import scipy.io as scio
 
-from os.path import isfile, splitext
+from scipy import sparse
+from os.path import isfile, isdir, splitext
+from connectivity import load_averaging_matrix, normalise_rows, triu_correlation, write_triu_correlation, \
+                         sparse_triu_correlation, subcortical_correlation, max_fc_deviation, load_time_series
 
 DESCRIPTION = """
   Calculate the functional connectivity (using Pearson Correlation) for the given mapping.
+  If --top_k or --threshold is given (and the output is not .h5), only the strongest FC values of each
+  row are kept while the rows are calculated, and FC is saved as a sparse (csr) upper triangular matrix.
+  A .npz output then holds the cortical FC only (see scipy.sparse.load_npz), and the subcortical FC is
+  saved to a separate _subcortical.mat file.
 """
 
 
@@ -16,13 +24,41 @@ def _build_args_parser():
                                 description=DESCRIPTION)
 
     p.add_argument('--time_series', action='store', metavar='TIME_SERIES', required=True,
-                   type=str, help='Path of the .npz file containing functional time series.')
+                   type=str, help='Path of the .npz file (or directory of .npy files) containing functional time series.')
 
     p.add_argument('--mesh', action='store', metavar='MESH', required=True,
                    type=str, help='Path to the mapping for the resolution of the surfacecs (.npz).')
 
+    p.add_argument('--areas', action='store', metavar='AREAS', default=None,
+                   type=str, help='If set, path of the .npy file of full resolution vertex areas (output of\n' +
+                                  'calculate_vertex_areas.py), to average the time series weighted by area instead of by count.')
+
     p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
-                   type=str, help='Path of the .npz file to save the output to.')
+                   type=str, help='Path of the .mat file to save the output to. If the extension is .h5 or .hdf5\n' +
+                                  'the upper triangular FC is written to disk a block of rows at a time (out-of-core).')
+
+    p.add_argument('--block_size', action='store', metavar='BLOCK_SIZE', default=1000,
+                   type=int, help='Number of rows of the FC matrix to calculate at a time.')
+
+    p.add_argument('--memory', action='store', metavar='MEMORY', default=None,
+                   type=float, help='Memory budget (in MB) for each block of rows when writing out-of-core,\n' +
+                                    'overrides --block_size.')
+
+    p.add_argument('--threshold', action='store', metavar='THRESHOLD', default=None,
+                   type=float, help='If set, FC values with an absolute value below this are set to 0 (or not kept in sparse FC).')
+
+    p.add_argument('--top_k', action='store', metavar='TOP_K', default=None,
+                   type=int, help='If set, only keep the TOP_K FC values with the largest absolute value of each vertex (sparse FC).')
+
+    p.add_argument('--float32', action='store_true', dest='float32',
+                   help='If set, average the time series and calculate and save FC in single precision.')
+
+    p.add_argument('--validate', action='store_true', dest='validate',
+                   help='If set (with --float32), also calculate FC in double precision and report the maximum deviation.')
+
+    p.add_argument('--low_rank', action='store_true', dest='low_rank',
+                   help='If set, save the normalised mean time series (single precision) to the .npz output instead of\n' +
+                        'the FC matrix, from which FC is their product (see load_fc_factors in connectivity.py).')
 
     p.add_argument('--ts', action='store_true', dest='ts',
                    help='If set, also save mean BOLD signal to file.')
@@ -33,29 +69,21 @@ def _build_args_parser():
     return p
 
 
-# calculate the 2D (vector) Pearson correlation
-def corr2(X, Y):
-    X_mX = X - X.mean(axis=1).reshape((-1, 1))
-    Y_mY = Y - Y.mean(axis=1).reshape((-1, 1))
-
-    ssX = (X_mX**2).sum(axis=1).reshape((-1, 1))
-    ssY = (Y_mY**2).sum(axis=1).reshape((1, -1))
-
-    return np.dot(X_mX, Y_mY.T) / np.sqrt(np.dot(ssX, ssY))
-
-
 def main():
     parser = _build_args_parser()
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
 
     # make sure the input files exist
-    if not isfile(args.time_series):
+    if not (isfile(args.time_series) or isdir(args.time_series)):
         parser.error('The file "{0}" must exist.'.format(args.time_series))
 
     if not isfile(args.mesh):
         parser.error('The file "{0}" must exist.'.format(args.mesh))
 
+    if args.areas is not None and not isfile(args.areas):
+        parser.error('The file "{0}" must exist.'.format(args.areas))
+
     # make sure files are not accidently overwritten
     if isfile(args.output):
         if args.overwrite:
@@ -63,6 +91,36 @@ def main():
         else:
             parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
 
+    if args.validate and not args.float32:
+        parser.error('--validate compares single to double precision, and requires --float32.')
+
+    if args.low_rank and not splitext(args.output)[1] == '.npz':
+        parser.error('The output must be a .npz file when using --low_rank.')
+
+    is_sparse = (args.top_k is not None or args.threshold is not None) and \
+                not splitext(args.output)[1] in ['.h5', '.hdf5']
+
+    if args.top_k is not None and splitext(args.output)[1] in ['.h5', '.hdf5']:
+        parser.error('--top_k can not be used when writing out-of-core.')
+
+    if args.top_k is not None and args.top_k < 1:
+        parser.error('--top_k must be at least 1.')
+
+    if args.low_rank and (args.top_k is not None or args.threshold is not None):
+        parser.error('--top_k and --threshold can not be used with --low_rank.')
+
+    if is_sparse and not splitext(args.output)[1] in ['.mat', '.npz']:
+        parser.error('The output must be a .mat or .npz file for sparse FC.')
+
+    if is_sparse and splitext(args.output)[1] == '.npz':
+        sub_output = splitext(args.output)[0] + '_subcortical.mat'
+
+        if isfile(sub_output):
+            if args.overwrite:
+                logging.info('Overwriting "{0}".'.format(sub_output))
+            else:
+                parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(sub_output))
+
     if args.ts == True:
         ts_output = splitext(args.output)[0] + '_ts.mat'
 
@@ -78,104 +136,141 @@ def main():
     mapping = mesh['mapping']
     shape = mesh['shape']
 
+    dtype = np.float32 if args.float32 else np.float64
+
     logging.info('Loading timeseries data.')
 
     # load time series for left and right hemispheres
-    full_time_series_data = np.load(args.time_series)
+    full_time_series_data = load_time_series(args.time_series)
     time_series_data = np.concatenate((full_time_series_data['lh_time_series'], 
-                                       full_time_series_data['rh_time_series']))
+                                       full_time_series_data['rh_time_series']), dtype=dtype)
 
     logging.info('TS length:' + str(time_series_data.shape))
     logging.info('Calculating mean signal for ' + str(shape[0]) + ' vertices.')
 
-    # initialise an array to fill in the loop
-    mean_time_series = np.empty([shape[0], time_series_data.shape[1]], dtype=np.float64)
+    # the time series only have subcortical labels if subcortical ROIs were given
+    if 'subcortical_labels' in full_time_series_data:
+        labels = full_time_series_data['subcortical_labels']
+    else:
+        labels = []
 
-    # calculate mean signal at each 
-    # vertice given the current mapping
-    for i in range(shape[0]):
-        vertex = mapping[i]
-        mean_time_series[i, :] = np.mean(time_series_data[vertex, :], axis=0)
+    n_sub = len(labels)
 
-    logging.info('Calculating FC.')
+    # the mean signal of the subcortical regions is stacked before the mean signal of the vertices,
+    # so that all rows are normalised together and all FC values come from the same matrix
+    mean_time_series = np.empty([n_sub + shape[0], time_series_data.shape[1]], dtype=dtype)
 
-    n = shape[0]
-    fc = np.ones(((n * (n+1)) / 2))
-    index = 0
+    # calculate the mean signal of the subcortical regions
+    for i in range(n_sub):
+        mean_time_series[i,:] = np.mean(full_time_series_data[labels[i]], axis=0)
 
-    # calculate the FC using an upper triangular indexing scheme
-    for i in xrange(n-1):
-        index += 1
-        offset = n - i
+    # calculate mean signal at each vertex given the current mapping
+    mean_time_series[n_sub:] = load_averaging_matrix(args.mesh, dtype, areas=args.areas).dot(time_series_data)
 
-        # calculate the correlation between the current vertex all the vertices in the vector that come after it
-        fc[index:(index+offset-1)] = corr2(mean_time_series[i:(i+1), :], mean_time_series[(i+1):, :]).ravel()
+    del time_series_data
 
-        # used for upper triangular indices
-        index += offset-1
+    # normalise the mean time series once, FC is then a matrix product
+    Z = normalise_rows(mean_time_series)
+    norm_time_series = Z[n_sub:]
 
-    result = np.zeros((n,n))
-    result[np.triu_indices(n)] = fc
+    # compare the FC of the single precision time series to the FC calculated in double precision
+    if args.validate:
+        logging.info('Calculating FC in double precision.')
 
-    # replace all nans with 0s
-    result = np.nan_to_num(result)
+        reference_time_series = np.empty(mean_time_series.shape, dtype=np.float64)
 
-    sub_sub_fc = None
-    sub_surf_fc = None
+        for i in range(n_sub):
+            reference_time_series[i,:] = np.mean(full_time_series_data[labels[i]], axis=0)
 
-    labels = full_time_series_data['subcortical_labels']
+        reference_time_series[n_sub:] = load_averaging_matrix(args.mesh, areas=args.areas).dot(
+            np.concatenate((full_time_series_data['lh_time_series'], full_time_series_data['rh_time_series'])))
 
-    # calculate subcortical FC
-    if not labels is None:
-        logging.info('Calculating FC for subcortical regions.')
-         
-        n = len(labels)
-        sub_mean_time_series = np.empty([n, time_series_data.shape[1]], dtype=np.float64)
-        
-        for i in range(n):
-            sub_mean_time_series[i,:] = np.mean(full_time_series_data[labels[i]], axis=0)
-   
-        fc = np.ones(((n * (n+1)) / 2))
-        index = 0
+        reference_time_series = normalise_rows(reference_time_series)
 
-        # calculate the subcortico-subcortical FC using an upper triangular indexing scheme
-        for i in xrange(n-1):
-            index += 1
-            offset = n - i
+        deviation = max_fc_deviation(Z, reference_time_series, args.block_size)
 
-            fc[index:(index+offset-1)] = corr2(sub_mean_time_series[i:(i+1), :], 
-                                               sub_mean_time_series[(i+1):, :]).ravel()
+        logging.info('Maximum deviation of FC from double precision: {0:.3g}'.format(deviation))
 
-            # used for upper triangular indices
-            index += offset-1
+        del reference_time_series
 
-        sub_sub_fc = np.zeros((n,n))
-        sub_sub_fc[np.triu_indices(n)] = fc
+    if args.low_rank:
+        logging.info('Saving FC as normalised time series.')
 
-        # replace all nans with 0s
-        sub_sub_fc = np.nan_to_num(sub_sub_fc)
+        # FC is the product of the normalised time series with themselves (see load_fc_factors)
+        factors = {'fc_factors': norm_time_series.astype(np.float32)}
 
-        # calculate the cortico-subcortical FC
-        sub_surf_fc = np.ones((n, shape[0]))
+        if len(labels) > 0:
+            factors['sub_fc_factors'] = Z[:n_sub].astype(np.float32)
+            factors['subcortical_labels'] = labels
 
-        # calculate the subcortico-subcortical FC using an upper triangular indexing scheme
-        for i in range(n):
-            sub_surf_fc[i,:] = corr2(sub_mean_time_series[i:(i+1), :], mean_time_series[:,:]).ravel()
+        np.savez(args.output, **factors)
+    elif splitext(args.output)[1] in ['.h5', '.hdf5']:
+        n = shape[0]
+        block_size = args.block_size
 
-        # replace all nans with 0s
-        sub_surf_fc = np.nan_to_num(sub_surf_fc)
-
-    # save the results
-    if not labels is None:
-        scio.savemat(args.output, {'fc': result, 
-                                   'sub_sub_fc': sub_sub_fc, 
-                                   'sub_surf_fc': sub_surf_fc})
-        if args.ts == True:
-            scio.savemat(ts_output, {'cortical_ts': mean_time_series,
-                                     'subcortical_ts': sub_mean_time_series})
+        # a block of rows (updated in place) and its conversion when written must fit in the memory budget
+        if args.memory is not None:
+            block_size = max(1, int(args.memory * 1024**2 / (2 * n * np.dtype(dtype).itemsize)))
+
+        logging.info('Writing FC to disk {0} rows at a time.'.format(block_size))
+
+        h5_file = h5py.File(args.output, 'w')
+
+        # chunks below the diagonal are never written, so only the upper triangle is stored
+        chunks = (min(block_size, n, 256), min(n, 256))
+        fc_dataset = h5_file.create_dataset('fc', shape=(n, n), dtype=dtype, chunks=chunks,
+                                            compression='gzip', compression_opts=1, fillvalue=0)
+
+        write_triu_correlation(norm_time_series, fc_dataset, block_size, args.threshold)
+
+        if len(labels) > 0:
+            logging.info('Calculating FC for subcortical regions.')
+
+            sub_sub_fc, sub_surf_fc = subcortical_correlation(Z, n_sub)
+
+            h5_file.create_dataset('sub_sub_fc', data=sub_sub_fc.astype(dtype))
+            h5_file.create_dataset('sub_surf_fc', data=sub_surf_fc.astype(dtype))
+
+        h5_file.close()
+    elif is_sparse:
+        logging.info('Calculating sparse FC.')
+
+        fc = {'fc': sparse_triu_correlation(norm_time_series, args.block_size, args.top_k, args.threshold)}
+
+        logging.info('Kept {0} FC values.'.format(fc['fc'].nnz))
+
+        if len(labels) > 0:
+            logging.info('Calculating FC for subcortical regions.')
+
+            fc['sub_sub_fc'], fc['sub_surf_fc'] = subcortical_correlation(Z, n_sub)
+
+        if splitext(args.output)[1] == '.npz':
+            sparse.save_npz(args.output, fc.pop('fc'))
+
+            if len(labels) > 0:
+                scio.savemat(sub_output, fc)
+        else:
+            scio.savemat(args.output, fc)
     else:
-        scio.savemat(args.output, {'fc': result})
-        if args.ts == True:
+        logging.info('Calculating FC.')
+
+        # replace all nans with 0s
+        fc = {'fc': np.nan_to_num(triu_correlation(norm_time_series, args.block_size))}
+
+        # calculate the subcortico-subcortical and cortico-subcortical FC
+        if len(labels) > 0:
+            logging.info('Calculating FC for subcortical regions.')
+
+            fc['sub_sub_fc'], fc['sub_surf_fc'] = subcortical_correlation(Z, n_sub)
+
+        scio.savemat(args.output, fc)
+
+    # save the mean time series
+    if args.ts == True:
+        if len(labels) > 0:
+            scio.savemat(ts_output, {'cortical_ts': mean_time_series[n_sub:],
+                                     'subcortical_ts': mean_time_series[:n_sub]})
+        else:
             scio.savemat(ts_output, {'cortical_ts': mean_time_series})
 
 
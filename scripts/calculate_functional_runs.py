@@ -0,0 +1,298 @@
+import argparse
+import logging
+import os
+
+import nibabel as nib
+import numpy as np
+import scipy.io as scio
+
+from multiprocessing import Pool
+from os.path import isdir, isfile, join
+from connectivity import load_averaging_matrix, surface_blocks, roi_voxels, load_roi_time_series, \
+                         load_confounders, regress_out, functional_connectivity, normalise_rows, max_fc_deviation
+
+DESCRIPTION = """
+  Calculate the residual time series and FC for several fsfast BOLD runs in one process. The mapping,
+  averaging matrix and subcortical voxels are loaded once and shared by all runs, which can be processed
+  in parallel. The outputs of each run are the same as calculate_residual_timeseries.py and calculate_fc.py,
+  saved in a RUN### directory (numbered in the given order). Optionally, the Fisher z averaged FC over
+  all runs is also saved.
+"""
+
+
+def _build_args_parser():
+    p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                description=DESCRIPTION)
+
+    p.add_argument('--runs', nargs='+', action='store', metavar='RUNS', required=True,
+                   type=str, help='Paths of the fsfast BOLD run directories.')
+
+    p.add_argument('--mesh', action='store', metavar='MESH', required=True,
+                   type=str, help='Path to the mapping for the resolution of the surfaces (.npz).')
+
+    p.add_argument('--areas', action='store', metavar='AREAS', default=None,
+                   type=str, help='If set, path of the .npy file of full resolution vertex areas (output of\n' +
+                                  'calculate_vertex_areas.py), to average the time series weighted by area instead of by count.')
+
+    p.add_argument('--aparc', action='store', metavar='APARC', required=False, default='',
+                   type=str, help='Path of the parcellation image used for subcortical volumes.')
+
+    p.add_argument('--sub_rois', nargs='+', metavar='SUB_ROIS', required=False, default=None,
+                   type=int, help='Labels of the subcortical ROIs to calculate the FC for.')
+
+    p.add_argument('--lh_time_series', action='store', metavar='LH_TIME_SERIES', default='fmcpr.sm5.fsaverage.lh.nii.gz',
+                   type=str, help='Name of the left hemisphere time series in each run directory.')
+
+    p.add_argument('--rh_time_series', action='store', metavar='RH_TIME_SERIES', default='fmcpr.sm5.fsaverage.rh.nii.gz',
+                   type=str, help='Name of the right hemisphere time series in each run directory.')
+
+    p.add_argument('--sub_time_series', action='store', metavar='SUB_TIME_SERIES', default='fmcpr.sm5.mni305.2mm.nii.gz',
+                   type=str, help='Name of the volume time series in each run directory.')
+
+    p.add_argument('--motion', action='store', metavar='MOTION', default='fmcpr.mcdat',
+                   type=str, help='Name of the motion nuisance regressor file in each run directory (\'\' to skip).')
+
+    p.add_argument('--wm', action='store', metavar='WM', default='wm.dat',
+                   type=str, help='Name of the white matter nuisance regressor file in each run directory (\'\' to skip).')
+
+    p.add_argument('--vcsf', action='store', metavar='VCSF', default='vcsf.dat',
+                   type=str, help='Name of the ventricle/csf nuisance regressor file in each run directory (\'\' to skip).')
+
+    p.add_argument('--gsl', action='store', metavar='GSL', default='global.waveform.dat',
+                   type=str, help='Name of the global signal nuisance regressor file in each run directory (\'\' to skip).')
+
+    p.add_argument('--detrend', action='store', metavar='DETREND', required=False, default=2,
+                   type=int, help='Order of polynomial to use in detrending the time series')
+
+    p.add_argument('--output_dir', action='store', metavar='OUTPUT_DIR', required=True,
+                   type=str, help='Path of the directory to create the RUN### directories in.')
+
+    p.add_argument('--ts_output', action='store', metavar='TS_OUTPUT', default='fc_ts_partial.npz',
+                   type=str, help='Name of the .npz file of residual time series in each RUN### directory.')
+
+    p.add_argument('--fc_output', action='store', metavar='FC_OUTPUT', required=True,
+                   type=str, help='Name of the .mat file of FC in each RUN### directory.')
+
+    p.add_argument('--average', action='store', metavar='AVERAGE', required=False, default=None,
+                   type=str, help='If set, path of the .mat file to save the Fisher z averaged FC over all runs to.')
+
+    p.add_argument('--block_size', action='store', metavar='BLOCK_SIZE', required=False, default=10000,
+                   type=int, help='Number of vertices to read and regress at a time.')
+
+    p.add_argument('--float32', action='store_true', dest='float32',
+                   help='If set, save the residual time series and calculate and save FC in single precision\n' +
+                        '(the regression is still done in double precision).')
+
+    p.add_argument('--validate', action='store_true', dest='validate',
+                   help='If set (with --float32), also calculate the FC of each run in double precision and report the maximum deviation.')
+
+    p.add_argument('--processes', action='store', metavar='PROCESSES', required=False, default=1,
+                   type=int, help='Number of runs to process in parallel.')
+
+    p.add_argument('-f', action='store_true', dest='overwrite',
+                   help='If set, overwrite files if they already exist.')
+
+    return p
+
+
+# averaging matrix and subcortical voxels shared by all runs
+_shared = {}
+
+
+def _init_shared(average, voxels, args):
+    _shared['average'] = average
+    _shared['voxels'] = voxels
+    _shared['args'] = args
+
+
+# residual time series and FC of a single run
+def process_run(run):
+    run_dir, output_dir = run
+    average = _shared['average']
+    voxels = _shared['voxels']
+    args = _shared['args']
+
+    logging.info('Processing "{0}".'.format(run_dir))
+
+    lh_filename = join(run_dir, args.lh_time_series)
+    rh_filename = join(run_dir, args.rh_time_series)
+
+    # only the headers are read here, the time series are read a block of vertices at a time
+    shape_lh = nib.load(lh_filename).shape
+    shape_rh = nib.load(rh_filename).shape
+
+    regressors = [join(run_dir, name) if not name == '' else '' for name in [args.motion, args.wm, args.vcsf, args.gsl]]
+    confounders = load_confounders(shape_rh[3], *(regressors + [args.detrend]))
+
+    # orthonormal basis of the confounders, the same for all time series
+    q, _ = np.linalg.qr(confounders)
+
+    dtype = np.float32 if args.float32 else np.float64
+
+    # the double precision residuals are only kept to validate the single precision ones
+    residual_dtype = np.float64 if args.validate else dtype
+
+    time_series = dict()
+
+    lh_residuals = np.empty([shape_lh[0], shape_lh[3]], dtype=residual_dtype)
+
+    for start, stop, block in surface_blocks(lh_filename, args.block_size):
+        lh_residuals[start:stop] = regress_out(block, q)
+
+    rh_residuals = np.empty([shape_rh[0], shape_rh[3]], dtype=residual_dtype)
+
+    for start, stop, block in surface_blocks(rh_filename, args.block_size):
+        rh_residuals[start:stop] = regress_out(block, q)
+
+    sub_mean_time_series = None
+    reference_sub_time_series = None
+
+    if voxels is not None:
+        roi_time_series = load_roi_time_series(join(run_dir, args.sub_time_series), voxels)
+
+        if args.validate:
+            reference_sub_time_series = np.array([np.mean(regress_out(roi_data, q), axis=0) for roi_data in roi_time_series])
+
+        for roi, roi_data in zip(args.sub_rois, roi_time_series):
+            time_series['label_' + str(roi)] = regress_out(roi_data, q).astype(dtype)
+
+        sub_mean_time_series = np.array([np.mean(time_series['label_' + str(roi)], axis=0) for roi in args.sub_rois])
+
+    if args.validate:
+        reference_time_series = average.astype(np.float64).dot(np.concatenate((lh_residuals, rh_residuals)))
+
+        lh_residuals = lh_residuals.astype(dtype)
+        rh_residuals = rh_residuals.astype(dtype)
+
+    time_series['lh_time_series'] = lh_residuals
+    time_series['rh_time_series'] = rh_residuals
+
+    # the labels are only saved with subcortical ROIs, so that the file can be loaded without pickle
+    if voxels is not None:
+        time_series['subcortical_labels'] = ['label_' + lbl for lbl in map(str, args.sub_rois)]
+
+    np.savez_compressed(join(output_dir, args.ts_output), **time_series)
+
+    # calculate mean signal at each vertex given the current mapping
+    mean_time_series = average.dot(np.concatenate((lh_residuals, rh_residuals)))
+
+    result = functional_connectivity(mean_time_series, sub_mean_time_series)
+    scio.savemat(join(output_dir, args.fc_output), result)
+
+    # compare the FC of the single precision time series to the FC calculated in double precision,
+    # with the subcortical rows stacked with the cortical ones so all FC values are compared
+    if args.validate:
+        if sub_mean_time_series is not None:
+            mean_time_series = np.concatenate([sub_mean_time_series, mean_time_series])
+            reference_time_series = np.concatenate([reference_sub_time_series, reference_time_series])
+
+        deviation = max_fc_deviation(normalise_rows(mean_time_series), normalise_rows(reference_time_series))
+
+        logging.info('Maximum deviation of the FC of "{0}" from double precision: {1:.3g}'.format(run_dir, deviation))
+
+    return join(output_dir, args.fc_output)
+
+
+def main():
+    parser = _build_args_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    has_subcortical = (args.aparc != '') & (args.sub_rois != None)
+
+    if (has_subcortical == False) and ((args.aparc != '') or (args.sub_rois != None)):
+        parser.error('Must have atlas and ROI list for subcortical signal')
+
+    # make sure the input files exist
+    for run_dir in args.runs:
+        if not isdir(run_dir):
+            parser.error('The directory "{0}" must exist.'.format(run_dir))
+
+        for name in [args.lh_time_series, args.rh_time_series, args.motion, args.wm, args.vcsf, args.gsl]:
+            if not name == '' and not isfile(join(run_dir, name)):
+                parser.error('The file "{0}" must exist.'.format(join(run_dir, name)))
+
+        if has_subcortical and not isfile(join(run_dir, args.sub_time_series)):
+            parser.error('The file "{0}" must exist.'.format(join(run_dir, args.sub_time_series)))
+
+    if not isfile(args.mesh):
+        parser.error('The file "{0}" must exist.'.format(args.mesh))
+
+    if args.areas is not None and not isfile(args.areas):
+        parser.error('The file "{0}" must exist.'.format(args.areas))
+
+    if has_subcortical and not isfile(args.aparc):
+        parser.error('The file "{0}" must exist.'.format(args.aparc))
+
+    if args.detrend < 0:
+        parser.error('Order of polynomial must be non-nengative, or 0 for no detrending of the time series.')
+
+    if args.detrend > 5:
+        parser.error('Order of polynomial is too large.')
+
+    if args.validate and not args.float32:
+        parser.error('--validate compares single to double precision, and requires --float32.')
+
+    runs = [(run_dir, join(args.output_dir, 'RUN{0:03d}'.format(i + 1))) for i, run_dir in enumerate(args.runs)]
+
+    # make sure files are not accidently overwritten
+    outputs = [join(output_dir, name) for _, output_dir in runs for name in [args.ts_output, args.fc_output]]
+
+    if args.average is not None:
+        outputs.append(args.average)
+
+    for output in outputs:
+        if isfile(output):
+            if args.overwrite:
+                logging.info('Overwriting "{0}".'.format(output))
+            else:
+                parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(output))
+
+    for _, output_dir in runs:
+        if not isdir(output_dir):
+            os.makedirs(output_dir)
+
+    # load everything that is shared by the runs once
+    average = load_averaging_matrix(args.mesh, np.float32 if args.float32 else np.float64, areas=args.areas)
+    voxels = roi_voxels(args.aparc, args.sub_rois) if has_subcortical else None
+
+    logging.info('Processing {0} runs.'.format(len(runs)))
+
+    if args.processes > 1:
+        pool = Pool(args.processes, _init_shared, (average, voxels, args))
+        fc_files = pool.map(process_run, runs)
+        pool.close()
+    else:
+        _init_shared(average, voxels, args)
+        fc_files = [process_run(run) for run in runs]
+
+    # average the Fisher z-transformed FC over runs, one run at a time
+    if args.average is not None:
+        logging.info('Averaging FC over runs.')
+
+        result = dict()
+
+        for fc_file in fc_files:
+            fc = scio.loadmat(fc_file)
+
+            for key in ['fc', 'sub_sub_fc', 'sub_surf_fc']:
+                if key in fc:
+                    # in the unlikely case of perfect correlation, atanh is not defined (the sum is
+                    # accumulated in double precision, as the clip would round to 1 in single precision)
+                    z = np.arctanh(fc[key].astype(np.float64).clip(-1+1e-15, 1-1e-15))
+                    result[key] = result[key] + z if key in result else z
+
+        for key in result.keys():
+            result[key] = np.tanh(result[key] / len(fc_files)).astype(np.float32 if args.float32 else np.float64)
+
+        # keep the upper triangular layout with ones on the diagonal
+        for key in ['fc', 'sub_sub_fc']:
+            if key in result:
+                result[key] = np.triu(result[key])
+                np.fill_diagonal(result[key], 1)
+
+        scio.savemat(args.average, result)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import nibabel as nib
 import numpy as np
 
 from os.path import isfile, splitext
+from connectivity import surface_blocks, roi_voxels, load_roi_time_series, load_confounders, regress_out
 
 DESCRIPTION = """
   Regress out the given confounders from the timeseries data.
@@ -44,6 +45,12 @@ def _build_args_parser():
     p.add_argument('--detrend', action='store', metavar='DETREND', required=False, default=2,
                    type=int, help='Order of polynomial to use in detrending the time series')
 
+    p.add_argument('--block_size', action='store', metavar='BLOCK_SIZE', required=False, default=10000,
+                   type=int, help='Number of vertices to read and regress at a time.')
+
+    p.add_argument('--float32', action='store_true', dest='float32',
+                   help='If set, save the residual time series in single precision.')
+
     p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
                    type=str, help='Path of the .npz file to save the output to.')
 
@@ -101,77 +108,43 @@ def main():
     if args.detrend > 5:
         parser.error('Order of polynomial is too large.')
 
-    # load time series for left and right hemispheres
-    time_series_lh = nib.load(args.lh_time_series)
-    time_series_data_lh = time_series_lh.get_data()
-    time_series_data_lh = time_series_data_lh[:, 0, 0, :]
+    dtype = np.float32 if args.float32 else np.float64
 
-    time_series_rh = nib.load(args.rh_time_series)
-    time_series_data_rh = time_series_rh.get_data()
-    time_series_data_rh = time_series_data_rh[:, 0, 0, :]
+    # only the headers are read here, the time series are read a block of vertices at a time
+    shape_lh = nib.load(args.lh_time_series).shape
+    shape_rh = nib.load(args.rh_time_series).shape
 
     # load confounder data
-    n = time_series_data_rh.shape[1]
-    confounders = np.ones([1, n])
-
-    # TODO: remove magic numbers
-    if not args.motion == '':
-        confounders = np.concatenate([confounders, np.genfromtxt(args.motion, dtype=np.float64).T[1:7, :]])
-
-    if not args.wm == '':
-        confounders = np.concatenate([confounders, np.genfromtxt(args.wm, dtype=np.float64).T[0:5, :]])
-
-    if not args.vcsf == '':
-        confounders = np.concatenate([confounders, np.genfromtxt(args.vcsf, dtype=np.float64).T[0:5, :]])
-
-    if not args.gsl == '':
-        confounders = np.concatenate([confounders, np.genfromtxt(args.gsl).reshape([1, n])])
-
-    # add time polynomial terms to detrend the timeseries
-    if not args.detrend == 0:
-        time = np.full((1,n), range(n))
-        confounders = np.concatenate([confounders, np.vstack([time**i for i in range(1, args.detrend+1)])]) 
+    confounders = load_confounders(shape_rh[3], args.motion, args.wm, args.vcsf, args.gsl, args.detrend)
 
-    confounders = confounders.T
-
-    XTX_inverse = np.linalg.inv(np.dot(confounders.T, confounders))
-    P = np.dot(np.dot(confounders, XTX_inverse), confounders.T) 
-    I = np.eye(confounders.shape[0])
+    # orthonormal basis of the confounders, the same for all time series
+    q, _ = np.linalg.qr(confounders)
 
     time_series = dict()
 
-    lh_residuals = np.zeros(time_series_data_lh.shape)
-    rh_residuals = np.zeros(time_series_data_rh.shape)
-
     logging.info('Calculating timeseries for left hemisphere')   
 
-    for i in range(time_series_lh.shape[0]):
-	lh_residuals[i, :] = time_series_data_lh[i, :] - np.dot(P, time_series_data_lh[i, :])
+    lh_residuals = np.empty([shape_lh[0], shape_lh[3]], dtype=dtype)
+
+    for start, stop, block in surface_blocks(args.lh_time_series, args.block_size):
+        lh_residuals[start:stop] = regress_out(block, q)
 
     logging.info('Calculating timeseries for right hemisphere')   
 
-    for i in range(time_series_rh.shape[0]):
-	rh_residuals[i, :] = time_series_data_rh[i, :] - np.dot(P, time_series_data_rh[i, :])
+    rh_residuals = np.empty([shape_rh[0], shape_rh[3]], dtype=dtype)
+
+    for start, stop, block in surface_blocks(args.rh_time_series, args.block_size):
+        rh_residuals[start:stop] = regress_out(block, q)
 
-    logging.info('Calculating timeseries for subcortical regions')   
- 
     # load time series for subcortical regions
     if has_subcortical == True:
-        ts_data = nib.load(args.sub_time_series)
-        ts_data = ts_data.get_data()
-
-        # load label images
-        label_img = nib.load(args.aparc)
-        label_data = label_img.get_data().astype('int')
+        logging.info('Calculating timeseries for subcortical regions')   
 
-        for roi in args.sub_rois:
-            xyz = np.nonzero(label_data == roi)
+        roi_time_series = load_roi_time_series(args.sub_time_series, roi_voxels(args.aparc, args.sub_rois))
 
+        for roi, roi_data in zip(args.sub_rois, roi_time_series):
             label_name = 'label_' + str(roi)
-            time_series[label_name] = ts_data[xyz]
-
-            for i in range(time_series[label_name].shape[0]):
-  	        time_series[label_name][i, :] = time_series[label_name][i, :] - np.dot(P, time_series[label_name][i, :])
+            time_series[label_name] = regress_out(roi_data, q).astype(dtype)
 
     # save the results
     time_series['lh_time_series'] = lh_residuals
@@ -7,9 +7,10 @@ import scipy.io as scio
 
 from scipy import sparse
 from os.path import isfile
+from connectivity import mapping_matrix, load_endpoints, endpoint_histogram, aggregate_histogram
 
 DESCRIPTION = """
-  Map tract endpoints to vertices on the downsampled surface and calculate SC matrix.
+  Map tract endpoints to vertices on the downsampled surfaces and calculate an SC matrix for each.
 """
 
 
@@ -17,14 +18,20 @@ def _build_args_parser():
     p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
                                 description=DESCRIPTION)
 
-    p.add_argument('--intersections', action='store', metavar='INTERSECTIONS', required=True,
-                   type=str, help='Path of the .npz file of intersections that have been snapped to nearest vertices.')
+    source = p.add_mutually_exclusive_group(required=True)
 
-    p.add_argument('--mesh', action='store', metavar='MESH', required=True,
-                   type=str, help='Path to the downsampled mesh .npz file.')
+    source.add_argument('--intersections', action='store', metavar='INTERSECTIONS',
+                        type=str, help='Path of the .npz file of intersections that have been snapped to nearest vertices.')
 
-    p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
-                   type=str, help='Path of the .npz file of structural connectivity matrix.')
+    source.add_argument('--histogram', action='store', metavar='HISTOGRAM',
+                        type=str, help='Path of the .npz file of the full resolution endpoint histogram\n' +
+                                       '(output of calculate_endpoint_histogram.py).')
+
+    p.add_argument('--mesh', type=str, nargs='+', required=True,
+                   help='Paths to the downsampled mesh .npz files, SC is calculated for each of them.')
+
+    p.add_argument('--output', type=str, nargs='+', required=True,
+                   help='Paths of the .mat files of structural connectivity matrices (one for each mesh).')
 
     p.add_argument('--count', action='store_true', dest='count',
                    help='If set, SC is calculated as total count instead of mean count.')
@@ -35,90 +42,108 @@ def _build_args_parser():
     return p
 
 
-def main():
-    parser = _build_args_parser()
-    args = parser.parse_args()
-    logging.basicConfig(level=logging.INFO)
-
-    # make sure the input files exist
-    if not isfile(args.intersections):
-        parser.error('The file "{0}" must exist.'.format(args.intersections))
-
-    if not isfile(args.mesh):
-        parser.error('The file "{0}" must exist.'.format(args.mesh))
-
-    # make sure files are not accidently overwritten
-    if isfile(args.output):
-        if args.overwrite:
-            logging.info('Overwriting "{0}".'.format(args.output))
-        else:
-            parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
-
-    logging.info('Loading mapping and intersections.')
-
-    # load mapping for the given resolution
-    mesh = np.load(args.mesh, allow_pickle=True)
-
-    mapping = mesh['mapping']
-    shape = mesh['shape']
+# mapping from the vertices of a finer mesh to a coarser one, if every vertex of the finer
+# mesh is entirely within a single vertex of the coarser mesh and every vertex of the coarser
+# mesh is covered by the vertices of the finer mesh within it, otherwise None
+def nested_mapping(fine, coarse):
+    overlap = fine.T.dot(coarse).tocsr()
+    fine_sizes = np.asarray(fine.sum(axis=0)).ravel()
 
-    areas = np.empty(shape[0])
+    if not np.all(np.diff(overlap.indptr) == 1) or not np.all(overlap.data == fine_sizes):
+        return None
 
-    for i in range(shape[0]):
-      areas[i] = len(mapping[i])
+    overlap.data[:] = 1
 
-    # load intersections that have already been snapped to nearest vertices of full mesh
-    intersections = np.load(args.intersections, allow_pickle=True)
+    if not np.all(np.asarray(coarse.sum(axis=0)).ravel() == overlap.T.dot(fine_sizes)):
+        return None
 
-    surf_in = intersections['surf_ids0'].astype(np.int64)
-    surf_out = intersections['surf_ids1'].astype(np.int64)
-    id_in = intersections['v_ids0'].astype(np.int64)
-    id_out = intersections['v_ids1'].astype(np.int64)
+    return overlap
 
-    id_in[surf_in == 1] = id_in[surf_in == 1] + shape[4]
-    id_out[surf_out == 1] = id_out[surf_out == 1] + shape[4]
 
-    mask = (surf_in < 2) & (surf_out < 2)
-    id_in = id_in[mask]
-    id_out = id_out[mask]
+# ignore self connections, normalise and save the SC matrix
+def save_sc(sc_matrix, mapping_mat, count, output):
+    sc_matrix = sc_matrix.copy()
+    sc_matrix.setdiag(0)
+    sc_matrix.eliminate_zeros()
 
-    logging.info('Calculating SC for ' + str(len(id_in)) + ' streamlines.')
+    # get the mean connectivity
+    if count == False:
+        areas = np.asarray(mapping_mat.sum(axis=0)).ravel()
+        scale = sparse.diags(1.0 / areas)
+        sc_matrix = scale.dot(sc_matrix).dot(scale)
 
-    id_in_buf = id_in.copy()
-    id_out_buf = id_out.copy()
+    # save results
+    scio.savemat(output, {'sc': sc_matrix})
 
-    # map intersections to the given resolution
-    for i in range(shape[0]):
-        id_in[np.in1d(id_in_buf, mapping[i])] = i
-        id_out[np.in1d(id_out_buf, mapping[i])] = i
 
-    sc_matrix = sparse.dok_matrix((shape[0], shape[0]), dtype=np.double)
+def main():
+    parser = _build_args_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
 
-    # calculate the structural connectivity
-    for i in range(len(id_in)):
-        sc_matrix[id_in[i], id_out[i]] += 1
-    
-        # only count self connections once
-        if not id_in[i] == id_out[i]:
-            sc_matrix[id_out[i], id_in[i]] += 1
+    # make sure the input files exist
+    if args.intersections is not None and not isfile(args.intersections):
+        parser.error('The file "{0}" must exist.'.format(args.intersections))
 
-    # get the mean connectivity
-    for i in range(shape[0]):
-        area_a = areas[i]
+    if args.histogram is not None and not isfile(args.histogram):
+        parser.error('The file "{0}" must exist.'.format(args.histogram))
 
-        for j in range(i, shape[0]):
-            if i == j:
-                sc_matrix[i, j] = 0
-                continue
+    if not len(args.mesh) == len(args.output):
+        parser.error('The number of meshes and outputs must be the same.')
 
-            if args.count == False:
-                area_b = areas[j]
-                sc_matrix[i, j] = sc_matrix[i, j] / (area_a * area_b)
-            
-            sc_matrix[j, i] = sc_matrix[i, j]
+    for mesh in args.mesh:
+        if not isfile(mesh):
+            parser.error('The file "{0}" must exist.'.format(mesh))
 
-    # save results
-    scio.savemat(args.output, {'sc': sc_matrix})
+    # make sure files are not accidently overwritten
+    for output in args.output:
+        if isfile(output):
+            if args.overwrite:
+                logging.info('Overwriting "{0}".'.format(output))
+            else:
+                parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(output))
+
+    logging.info('Loading mappings and intersections.')
+
+    # load mappings for all the given resolutions
+    meshes = [np.load(mesh, allow_pickle=True) for mesh in args.mesh]
+    mappings = [mapping_matrix(mesh['mapping'], mesh['shape']) for mesh in meshes]
+    shape = meshes[0]['shape']
+
+    if args.histogram is not None:
+        histogram = sparse.load_npz(args.histogram)
+    else:
+        # load intersections that have already been snapped to nearest vertices of full mesh
+        intersections = np.load(args.intersections, allow_pickle=True)
+        id_in, id_out, _ = load_endpoints(intersections, shape)
+
+        histogram = endpoint_histogram(id_in, id_out, shape[3])
+
+    # aggregate from the finest to the coarsest resolution, so that a mapping nested in
+    # a finer one (all vertices of the finer mesh fall within one vertex of the coarser
+    # mesh) can be calculated from the (much smaller) finer result
+    order = np.argsort([-mapping.shape[1] for mapping in mappings], kind='mergesort')
+    counts = []
+
+    for i in order:
+        sc_matrix = None
+
+        # start from the coarsest result that has already been calculated
+        for j, finer in reversed(counts):
+            nested = nested_mapping(mappings[j], mappings[i])
+
+            if nested is not None:
+                logging.info('Calculating SC for {0} vertices from {1} vertices.'.format(mappings[i].shape[1], mappings[j].shape[1]))
+                sc_matrix = aggregate_histogram(finer, nested)
+                break
+
+        if sc_matrix is None:
+            logging.info('Calculating SC for {0} vertices.'.format(mappings[i].shape[1]))
+            sc_matrix = aggregate_histogram(histogram, mappings[i])
+
+        counts.append((i, sc_matrix))
+
+        save_sc(sc_matrix, mappings[i], args.count, args.output[i])
 
 
 if __name__ == "__main__":
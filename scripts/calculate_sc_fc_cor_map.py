@@ -4,6 +4,7 @@ import numpy as np
 import scipy.sparse as sparse
 
 from os.path import isfile
+from connectivity import load_fc_factors, fc_block
 
 DESCRIPTION = """
   Calculate the correlation between functional and structural connectivity (using Pearson Correlation) for the given mapping.
@@ -14,8 +15,13 @@ def _build_args_parser():
     p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
                                 description=DESCRIPTION)
 
-    p.add_argument('--fc_matrix', action='store', metavar='FC_MATRIX', required=True,
-                   type=str, help='Path of the file containing functional connectivity matrix.')
+    source = p.add_mutually_exclusive_group(required=True)
+
+    source.add_argument('--fc_matrix', action='store', metavar='FC_MATRIX',
+                        type=str, help='Path of the file containing functional connectivity matrix.')
+
+    source.add_argument('--fc_factors', action='store', metavar='FC_FACTORS',
+                        type=str, help='Path of the .npz file of normalised time series (output of calculate_fc.py --low_rank).')
 
     p.add_argument('--sc_matrix', action='store', metavar='SC_MATRIX', required=True,
                    type=str, help='Path of the file containing structural connectivity matrix.')
@@ -32,20 +38,40 @@ def _build_args_parser():
     p.add_argument('--fisher', action='store_true', dest='fisher', default=False,
                     help='Perform a Fisher z-transform on the FC before calculating correlation.')
 
+    p.add_argument('--block_size', action='store', metavar='BLOCK_SIZE', default=1000,
+                   type=int, help='Number of rows to calculate the correlations for at a time.')
+
     p.add_argument('-f', action='store_true', dest='overwrite',
                    help='If set, overwrite files if they already exist.')
 
     return p
 
 
+# pearson correlation between each row of x and y, using only the entries where mask is true.
+# rows with fewer than two entries, or without any variance, are nan
+def masked_row_correlation(x, y, mask):
+    count = mask.sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(mask, x, 0)
+        y = np.where(mask, y, 0)
+
+        x = np.where(mask, x - (x.sum(axis=1) / count).reshape((-1, 1)), 0)
+        y = np.where(mask, y - (y.sum(axis=1) / count).reshape((-1, 1)), 0)
+
+        return (x * y).sum(axis=1) / np.sqrt((x**2).sum(axis=1) * (y**2).sum(axis=1))
+
+
 def main():
     parser = _build_args_parser()
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
 
     # make sure the input files exist
-    if not isfile(args.fc_matrix):
-        parser.error('The file "{0}" must exist.'.format(args.fc_matrix))
+    source = args.fc_matrix if args.fc_matrix is not None else args.fc_factors
+
+    if not isfile(source):
+        parser.error('The file "{0}" must exist.'.format(source))
 
     if not isfile(args.sc_matrix):
         parser.error('The file "{0}" must exist.'.format(args.sc_matrix))
@@ -72,59 +98,63 @@ def main():
 
     logging.info('Calculating FC/SC correlation.')
 
-    # load sc matrix and make dense
-    sc = np.array(sparse.load_npz(args.sc_matrix).todense())
+    # load sc matrix and make it symmetric from the upper triangle (the diagonal is not used)
+    sc = sparse.load_npz(args.sc_matrix).tocsr()
+    sc_diagonal = sc.diagonal()
+
+    sc = sparse.triu(sc, 1)
+    sc = (sc + sc.T).tocsr()
 
-    # load fc and convert to upper triangle matrix
-    fc = np.zeros((n,n))
-    fc[np.triu_indices(n, 0)] = np.load(args.fc_matrix)['fc']
+    if args.fc_factors is not None:
+        # fc rows are calculated from the normalised time series when needed
+        Z, _ = load_fc_factors(args.fc_factors)
+    else:
+        # load fc and convert to upper triangle matrix
+        fc = np.zeros((n,n))
+        fc[np.triu_indices(n, 0)] = np.load(args.fc_matrix)['fc']
 
-    # perform fisher transformation
-    if args.fisher:
-        fc = np.arctanh(fc)
+        # perform fisher transformation
+        if args.fisher:
+            fc = np.arctanh(fc)
+
+        fc = np.triu(fc, 1)
 
-    # calculate the FC using an upper triangular indexing scheme
     result = np.zeros(n)
 
-    for i in xrange(n):
-        lower = i
-        upper = i+1
-        
-        # get the whole row from the triangular matrix
-	if i == 0:
-            fc_row = fc[i, upper:]
-            sc_row = sc[i, upper:]
-        elif i == (n-1):
-            fc_row = np.transpose(fc[0:lower, i])
-            sc_row = np.transpose(sc[0:lower, i])
+    # calculate the correlation of whole (symmetric) rows, a block of rows at a time
+    for start in range(0, n, args.block_size):
+        stop = min(start + args.block_size, n)
+        rows = np.arange(start, stop)
+
+        if args.fc_factors is not None:
+            fc_rows = fc_block(Z, slice(start, stop))
+
+            # perform fisher transformation (the diagonal is not used)
+            if args.fisher:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    fc_rows = np.arctanh(fc_rows)
         else:
-            fc_row = np.concatenate((np.transpose(fc[0:lower, i]), fc[i, upper:]))
-            sc_row = np.concatenate((np.transpose(sc[0:lower, i]), sc[i, upper:]))
-
-        if args.conditional > 1:
-            conditional_msk = sc_row >= 1
-            
-            # if not enough connections, set correlation to 0 and move on
-            if (sc[i,i] == 0) or (np.sum(conditional_msk) < args.conditional):
-                result[i] = 0
-                continue
-            
-            fc_row = fc_row[conditional_msk]
-            sc_row = sc_row[conditional_msk]
-
-        # remove nans from the matrices (caused by unknown regions)
-        mask_idx = ~np.isnan(fc_row)
-
-        # if all values in the row are nans, set the result to nan and move on
-        if not np.any(mask_idx):
-            #result[i] = np.nan
-            result[i] = -2
-            continue
-
-        result[i] = np.corrcoef(fc_row[mask_idx], sc_row[mask_idx])[0,1]
-
-        if np.isnan(result[i]):
-            result[i] = -2
+            fc_rows = fc[start:stop] + fc[:, start:stop].T
+        sc_rows = sc[start:stop].toarray()
+
+        # remove nans from the matrices (caused by unknown regions) and the diagonal
+        mask = ~np.isnan(fc_rows)
+        mask[rows - start, rows] = False
+
+        if args.conditional is not None:
+            mask &= (sc_rows >= 1)
+
+        corr = masked_row_correlation(fc_rows, sc_rows, mask)
+
+        # if all values in the row are nans, or the correlation is not defined, set the result to -2
+        corr[np.isnan(corr)] = -2
+
+        # if not enough connections, set correlation to 0
+        if args.conditional is not None:
+            connected = (sc_diagonal[start:stop] != 0) & ((sc_rows >= 1).sum(axis=1) >= args.conditional)
+            corr[~connected] = 0
+
+        result[start:stop] = corr
 
     # save the results
     np.savez_compressed(args.output, corr_map=result)
@@ -4,10 +4,12 @@ import numpy as np
 import scipy.sparse as sparse
 
 from scipy import stats
-from os.path import isfile
+from os.path import isfile, isdir
+from connectivity import load_averaging_matrix, normalise_rows, load_time_series
 
 DESCRIPTION = """
   Calculate the seed based correlation for functional and structural connectivity (using Pearson Correlation) using the given mapping.
+  If several seeds are given, the maps of all seeds are saved as rows (seeds x vertices) in the order given.
 """
 
 
@@ -15,14 +17,14 @@ def _build_args_parser():
     p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
                                 description=DESCRIPTION)
 
-    p.add_argument('--seed_id', action='store', metavar='SEED_ID', required=True,
-                   type=int, help='ID for the region to use as a seed.')
+    p.add_argument('--seed_id', action='store', metavar='SEED_ID', required=True, nargs='+',
+                   type=int, help='IDs for the regions to use as seeds.')
 
-    p.add_argument('--hemisphere', action='store', metavar='SEED_ID', required=True,
-                   type=int, help='Hemisphere the roi is located on (0 = left, 1 = right).')
+    p.add_argument('--hemisphere', action='store', metavar='HEMISPHERE', required=True, nargs='+',
+                   type=int, help='Hemisphere each roi is located on (0 = left, 1 = right), once for all seeds or once for each seed.')
 
     p.add_argument('--time_series', action='store', metavar='TIME_SERIES', required=True,
-                   type=str, help='Path of the file containing functional timeseries data.')
+                   type=str, help='Path of the file (or directory of .npy files) containing functional timeseries data.')
 
     p.add_argument('--sc_matrix', action='store', metavar='SC_MATRIX', required=True,
                    type=str, help='Path of the file containing structural connectivity matrix.')
@@ -33,6 +35,10 @@ def _build_args_parser():
     p.add_argument('--mesh', action='store', metavar='MESH', required=True,
                    type=str, help='Path to the mapping for the resolution of the surfacecs (.npz).')
 
+    p.add_argument('--areas', action='store', metavar='AREAS', default=None,
+                   type=str, help='If set, path of the .npy file of full resolution vertex areas (output of\n' +
+                                  'calculate_vertex_areas.py), to average the time series weighted by area instead of by count.')
+
     p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
                    type=str, help='Path of the .npz file to save the output to.')
 
@@ -42,14 +48,21 @@ def _build_args_parser():
     return p
 
 
+# -log10 of the two sided p-value of pearson correlations over n time points, from the t-distribution
+def log_p_values(corr, n):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = corr * np.sqrt((n - 2) / (1.0 - corr**2))
+        return -np.log10(2 * stats.t.sf(np.abs(t), n - 2))
+
+
 def main():
     parser = _build_args_parser()
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
 
     # make sure the input files exist
-    if not isfile(args.time_series):
-        parser.error('The file "{0}" must exist.'.format(args.fc_matrix))
+    if not (isfile(args.time_series) or isdir(args.time_series)):
+        parser.error('The file "{0}" must exist.'.format(args.time_series))
 
     if not isfile(args.roi):
         parser.error('The file "{0}" must exist.'.format(args.roi))
@@ -57,9 +70,20 @@ def main():
     if not isfile(args.mesh):
         parser.error('The file "{0}" must exist.'.format(args.mesh))
 
-    if not (args.hemisphere == 0) or (args.hemisphere == 1):
+    if args.areas is not None and not isfile(args.areas):
+        parser.error('The file "{0}" must exist.'.format(args.areas))
+
+    if not isfile(args.sc_matrix):
+        parser.error('The file "{0}" must exist.'.format(args.sc_matrix))
+
+    if not all([hemisphere in [0, 1] for hemisphere in args.hemisphere]):
         parser.error('The hemisphere must be 0=left or 1=right.')
 
+    if len(args.hemisphere) == 1:
+        args.hemisphere = args.hemisphere * len(args.seed_id)
+    elif not len(args.hemisphere) == len(args.seed_id):
+        parser.error('--hemisphere must be given once, or once for each seed.')
+
     # make sure files are not accidently overwritten
     if isfile(args.output):
         if args.overwrite:
@@ -80,19 +104,19 @@ def main():
     lh_labels = roi['lh_labels']
     rh_labels = roi['rh_labels']
 
-    if args.hemisphere == 0:
-        rh_labels[:] = 30000
-    else:
-        lh_labels[:] = 30000
-
+    # mask of the vertices of each seed, on the given hemisphere only
+    hemispheres = np.concatenate([np.zeros(len(lh_labels), dtype=int), np.ones(len(rh_labels), dtype=int)])
     labels = np.concatenate([lh_labels, rh_labels])
 
+    masks = np.array([(labels == seed_id) & (hemispheres == hemisphere)
+                      for seed_id, hemisphere in zip(args.seed_id, args.hemisphere)])
+
     # TODO: use names instead of IDs, so LH_ or RH_ name
     #lh_names=np.array(lh_annot[2])
     #rh_names=np.array(rh_annot[2])
 
     # load the FC matrix timeseries data (need to calculate fc again based on seed)
-    time_series = np.load(args.time_series)
+    time_series = load_time_series(args.time_series)
     lh_timeseries = time_series['lh_time_series']
     rh_timeseries = time_series['rh_time_series']
 
@@ -100,46 +124,49 @@ def main():
 
     logging.info('Calculating mean signal for ' + str(shape[0]) + ' vertices.')
 
-    mean_time_series = np.empty([shape[0], time_series_data.shape[1]], dtype=np.float64)
-    seed_time_series = np.empty([1, time_series_data.shape[1]], dtype=np.float64)
-
     # calculate mean signal for each resampled vertex
-    for i in range(shape[0]):
-        vertex = np.array(mapping[i])
-        mean_time_series[i, :] = np.mean(time_series_data[vertex, :], axis=0)
+    mean_time_series = load_averaging_matrix(args.mesh, areas=args.areas).dot(time_series_data)
 
-    region_mask = np.array(range(shape[0]))
-    region_mask = region_mask[labels == args.seed_id]
+    # calculate mean for each region of interest
+    seed_time_series = np.array([np.mean(time_series_data[np.concatenate(mapping[mask]), :], axis=0) for mask in masks])
 
-    # calculate mean for the region of interest
-    region_mapping = np.concatenate(mapping[region_mask])
-    seed_time_series[0, :] = np.mean(time_series_data[region_mapping, :], axis=0)
+    logging.info('Calculating FC strength for ' + str(len(masks)) + ' seeds.')
 
-    logging.info('Calculating FC strength.')
+    # correlation between each vertex and each seed as a single matrix product
+    norm_time_series = normalise_rows(mean_time_series)
+    corr = normalise_rows(seed_time_series).dot(norm_time_series.T)
 
-    mask = (labels == args.seed_id)
-    fc_mapping = np.zeros(n, dtype=np.float64)
-    fc_mapping[mask] = 1
+    # rounding can push the correlation slightly beyond +-1, which pearsonr clips as well
+    np.clip(corr, -1, 1, out=corr)
 
-    for i in range(shape[0]):
-        if not fc_mapping[i] == 1:
-            fc_mapping[i] = -np.log10(stats.pearsonr(seed_time_series[0, :], mean_time_series[i, :])[1])
-            
-        if np.isnan(fc_mapping[i]):
-            fc_mapping[i] = -2
+    # vertices (or seeds) without any variance have an undefined correlation
+    corr[:, ~np.any(norm_time_series != 0, axis=1)] = np.nan
+    corr[~np.any(seed_time_series != seed_time_series[:, :1], axis=1), :] = np.nan
+
+    fc_mapping = log_p_values(corr, time_series_data.shape[1])
+    fc_mapping[np.isnan(fc_mapping)] = -2
+    fc_mapping[masks] = 1
 
     logging.info('Calculating SC strength.')
 
-    # load the SC matrix (sc is caluclated by summing rows)
-    sc_matrix = np.array(sparse.load_npz(args.sc_matrix).todense())
-    sc_mapping = np.sum(sc_matrix[mask, :], axis=0)
-    sc_mapping = np.log(sc_mapping, where=(sc_mapping != 0))
+    # load the SC matrix (sc is caluclated by summing rows), summing the rows of each seed in sparse form
+    sc_matrix = sparse.load_npz(args.sc_matrix).tocsr()
+    selection = sparse.csr_matrix(masks.astype(np.float64))
+
+    sc_mapping = selection.dot(sc_matrix).toarray()
+    sc_mapping = np.log(sc_mapping, out=np.zeros_like(sc_mapping), where=(sc_mapping != 0))
+
+    for i, mask in enumerate(masks):
+        if np.any(sc_mapping[i, mask]):
+            sc_mapping[i, mask] = 1
 
-    if np.any(sc_mapping[mask]):
-        sc_mapping[mask] = 1
+    # a single seed is saved as a vector, as before
+    if len(masks) == 1:
+        fc_mapping = fc_mapping[0]
+        sc_mapping = sc_mapping[0]
 
     # save the results
-    np.savez_compressed(args.output, fc_mapping=fc_mapping, sc_mapping=sc_mapping)
+    np.savez_compressed(args.output, fc_mapping=fc_mapping, sc_mapping=sc_mapping, seed_ids=args.seed_id)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+import argparse
+import logging
+import vtk
+
+import numpy as np
+import vtk.util.numpy_support as ns
+
+from os.path import isfile
+
+DESCRIPTION = """
+  Calculate the area of every vertex of the full resolution surfaces (a third of the area of each
+  triangle it belongs to), left hemisphere first, to average time series weighted by area.
+"""
+
+
+def _build_args_parser():
+    p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                description=DESCRIPTION)
+
+    p.add_argument('--lh_surface', action='store', metavar='LH_SURFACE', required=True,
+                   type=str, help='Path of the full resolution .vtk mesh file for the left hemisphere.')
+
+    p.add_argument('--rh_surface', action='store', metavar='RH_SURFACE', required=True,
+                   type=str, help='Path of the full resolution .vtk mesh file for the right hemisphere.')
+
+    p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
+                   type=str, help='Path of the .npy file to save the output to.')
+
+    p.add_argument('-f', action='store_true', dest='overwrite',
+                   help='If set, overwrite files if they already exist.')
+
+    return p
+
+
+# helper function to load the .vtk surfaces
+def load_vtk(filename):
+    reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(filename)
+    reader.Update()
+
+    return reader.GetOutput()
+
+
+# area of every vertex of a triangle mesh, a third of the area of each of its triangles
+def vertex_areas(surface):
+    points = ns.vtk_to_numpy(surface.GetPoints().GetData()).astype(np.double)
+
+    polydata = ns.vtk_to_numpy(surface.GetPolys().GetData())
+    triangles = np.vstack([polydata[1::4], polydata[2::4], polydata[3::4]]).T
+
+    edges_a = points[triangles[:, 1]] - points[triangles[:, 0]]
+    edges_b = points[triangles[:, 2]] - points[triangles[:, 0]]
+    areas = 0.5 * np.linalg.norm(np.cross(edges_a, edges_b), axis=1)
+
+    return np.bincount(triangles.ravel(), weights=np.repeat(areas / 3.0, 3), minlength=points.shape[0])
+
+
+def main():
+    parser = _build_args_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # make sure the surface files exist
+    if not isfile(args.lh_surface):
+        parser.error('The file "{0}" must exist.'.format(args.lh_surface))
+
+    if not isfile(args.rh_surface):
+        parser.error('The file "{0}" must exist.'.format(args.rh_surface))
+
+    # make sure files are not accidently overwritten
+    if isfile(args.output):
+        if args.overwrite:
+            logging.info('Overwriting "{0}".'.format(args.output))
+        else:
+            parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
+
+    logging.info('Calculating vertex areas.')
+
+    areas = np.concatenate([vertex_areas(load_vtk(args.lh_surface)), vertex_areas(load_vtk(args.rh_surface))])
+
+    # save the results
+    np.save(args.output, areas)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,19 @@
 import argparse
 import logging
-import nibabel as nib
+import os
+import shutil
+import tempfile
+import zipfile
+
 import numpy as np
 
-from os.path import isfile
+from os.path import isfile, isdir, dirname, abspath, join, splitext
 
 DESCRIPTION = """
-  Normalise and concatenate BOLD time series data.
+  Normalise and concatenate BOLD time series data. The shapes of all runs are read first so that
+  the output is allocated once, and each run is z-scored a block of rows at a time directly into
+  its part of the output. If the output is not a .npz file, it is a directory with a .npy file per
+  key, written as memory maps, which the FC scripts memory-map instead of loading.
 """
 
 
@@ -18,7 +25,19 @@ def _build_args_parser():
                    type=str, help='Path of the files containing functional time series to be concatenated.')
 
     p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
-                   type=str, help='Path of the .npz file to save the output to.')
+                   type=str, help='Path of the .npz file (or of the directory of .npy files) to save the output to.')
+
+    p.add_argument('--block_size', action='store', metavar='BLOCK_SIZE', required=False, default=10000,
+                   type=int, help='Number of rows to normalise at a time.')
+
+    p.add_argument('--float32', action='store_true', dest='float32',
+                   help='If set, save the time series in single precision.')
+
+    p.add_argument('--memmap', action='store_true', dest='memmap',
+                   help='If set, build the .npz output in memory maps next to the output file instead of in memory.')
+
+    p.add_argument('--uncompressed', action='store_true', dest='uncompressed',
+                   help='If set, save an uncompressed .npz file, which is much faster to write and read.')
 
     p.add_argument('-f', action='store_true', dest='overwrite',
                    help='If set, overwrite files if they already exist.')
@@ -26,6 +45,26 @@ def _build_args_parser():
     return p
 
 
+# read the shape of every array in a .npz file from the .npy headers, without loading the data
+def npz_shapes(filename):
+    shapes = dict()
+
+    with zipfile.ZipFile(filename) as archive:
+        for name in archive.namelist():
+            member = archive.open(name)
+            version = np.lib.format.read_magic(member)
+
+            if version == (1, 0):
+                shape, _, _ = np.lib.format.read_array_header_1_0(member)
+            else:
+                shape, _, _ = np.lib.format.read_array_header_2_0(member)
+
+            member.close()
+            shapes[name[:-len('.npy')] if name.endswith('.npy') else name] = shape
+
+    return shapes
+
+
 def main():
     parser = _build_args_parser()
     args = parser.parse_args()
@@ -37,34 +76,100 @@ def main():
             parser.error('The file "{0}" must exist.'.format(filename))
 
     # make sure files are not accidently overwritten
-    if isfile(args.output):
+    if isfile(args.output) or isdir(args.output):
         if args.overwrite:
             logging.info('Overwriting "{0}".'.format(args.output))
         else:
             parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
 
-    data = dict()
-
-    for filename in args.time_series:
-       time_series_data = np.load(filename)
-
-       for key in time_series_data.files:
-           if key == 'subcortical_labels':
-               data[key] = time_series_data[key]
-               continue
-
-           ts_std = time_series_data[key]
-           ts_std = (ts_std - ts_std.mean(1, keepdims=True)) / ts_std.std(1, keepdims=True)
-           ts_std = np.nan_to_num(ts_std)
-
-           if data.has_key(key) == False:
-               data[key] = ts_std 
-           else:
-               data[key] = np.concatenate((data[key], ts_std), axis=1) 
-           
-    # save the results
-    kwargs = {key: data[key] for key in data.keys()}
-    np.savez_compressed(args.output, **kwargs)
+    dtype = np.float32 if args.float32 else np.float64
+    is_npz = splitext(args.output)[1] == '.npz'
+
+    # find the size of the output for each key, and where each run goes in it (keys that are not
+    # time series, such as the subcortical labels, are taken from the runs as they are)
+    shapes = [npz_shapes(filename) for filename in args.time_series]
+    keys = []
+    rows = dict()
+    offsets = [dict() for _ in shapes]
+    lengths = dict()
+
+    for run_shapes, run_offsets in zip(shapes, offsets):
+        for key, shape in sorted(run_shapes.items()):
+            if not len(shape) == 2:
+                continue
+
+            if key not in rows:
+                keys.append(key)
+                rows[key] = shape[0]
+                lengths[key] = 0
+
+            if not shape[0] == rows[key]:
+                parser.error('The number of rows of "{0}" is not the same in all runs.'.format(key))
+
+            run_offsets[key] = lengths[key]
+            lengths[key] += shape[1]
+
+    logging.info('Concatenating {0} runs ({1} time points).'.format(len(args.time_series), max(lengths.values())))
+
+    # an existing output is removed first, so no keys of an earlier output are left in the directory
+    if not is_npz:
+        if isdir(args.output):
+            shutil.rmtree(args.output)
+        elif isfile(args.output):
+            os.remove(args.output)
+
+        os.makedirs(args.output)
+
+    # the .npz output is built in a temporary directory, the directory output in place
+    tmp_dir = tempfile.mkdtemp(dir=dirname(abspath(args.output))) if is_npz and args.memmap else None
+    memmap_dir = args.output if not is_npz else tmp_dir
+
+    try:
+        data = dict()
+
+        for key in keys:
+            if memmap_dir is not None:
+                data[key] = np.lib.format.open_memmap(join(memmap_dir, key + '.npy'), mode='w+',
+                                                      dtype=dtype, shape=(rows[key], lengths[key]))
+            else:
+                data[key] = np.empty([rows[key], lengths[key]], dtype=dtype)
+
+        for filename, run_offsets in zip(args.time_series, offsets):
+            time_series_data = np.load(filename, allow_pickle=True)
+
+            for key in time_series_data.files:
+                if key not in rows:
+                    data[key] = time_series_data[key]
+                    continue
+
+                ts = time_series_data[key]
+                start = run_offsets[key]
+                stop = start + ts.shape[1]
+
+                # z-score each row into its time slice of the output (in double precision, as the
+                # time series may have been saved in single precision)
+                for row in range(0, ts.shape[0], args.block_size):
+                    ts_std = ts[row:row + args.block_size].astype(np.float64)
+                    ts_std = (ts_std - ts_std.mean(1, keepdims=True)) / ts_std.std(1, keepdims=True)
+
+                    data[key][row:row + args.block_size, start:stop] = np.nan_to_num(ts_std)
+
+                del ts
+
+        # save the results
+        if not is_npz:
+            for key in data.keys():
+                if key in rows:
+                    data[key].flush()
+                else:
+                    np.save(join(args.output, key + '.npy'), data[key])
+        elif args.uncompressed:
+            np.savez(args.output, **data)
+        else:
+            np.savez_compressed(args.output, **data)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+import argparse
+import logging
+
+import numpy as np
+
+from os.path import isfile
+from spherical_harmonics import heat_kernel_weights, hemisphere_sph_harm
+
+DESCRIPTION = """
+  Compute the spherical harmonic coefficient matrix of the smoothed continuous SC from
+  endpoints in concon format (.tsv). The size of the result depends only on the number of
+  harmonics, and can be evaluated on any grid with evaluate_harmonics.py.
+"""
+
+
+def _build_args_parser():
+    p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                description=DESCRIPTION)
+
+    p.add_argument('--intersections', action='store', metavar='INTERSECTIONS', required=True,
+                   type=str, help='Path of the .tsv file of intersections in spherical coordinates (concon format).')
+
+    p.add_argument('--sigma', action='store', metavar='SIGMA', required=True,
+                   type=float, help='Bandwidth of the heat kernel used for smoothing (same as concon --sigma).')
+
+    p.add_argument('--num_harm', action='store', metavar='NUM_HARM', default=33,
+                   type=int, help='Number of harmonic degrees to use (same as concon --OPT_VAL_num_harm).')
+
+    p.add_argument('--chunk_size', action='store', metavar='CHUNK_SIZE', default=100000,
+                   type=int, help='Number of streamlines to process at a time.')
+
+    p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
+                   type=str, help='Path of the .npz file to save the coefficients to.')
+
+    p.add_argument('-f', action='store_true', dest='overwrite',
+                   help='If set, overwrite files if they already exist.')
+
+    return p
+
+
+def main():
+    parser = _build_args_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # make sure the input files exist
+    if not isfile(args.intersections):
+        parser.error('The file "{0}" must exist.'.format(args.intersections))
+
+    # make sure files are not accidently overwritten
+    if isfile(args.output):
+        if args.overwrite:
+            logging.info('Overwriting "{0}".'.format(args.output))
+        else:
+            parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
+
+    logging.info('Loading intersections.')
+
+    # columns: 0, hemisphere, x, y, z, 0, hemisphere, x, y, z (concon uses 1 for lh, 0 for rh)
+    xing = np.loadtxt(args.intersections, comments='#', ndmin=2)
+
+    hemi_in = (1 - xing[:, 1]).astype(np.int64)
+    hemi_out = (1 - xing[:, 6]).astype(np.int64)
+    pts_in = xing[:, 2:5]
+    pts_out = xing[:, 7:10]
+
+    n = xing.shape[0]
+    weights = heat_kernel_weights(args.num_harm, args.sigma)
+
+    logging.info('Calculating {0} harmonic coefficients for {1} streamlines.'.format(2 * len(weights), n))
+
+    coefs = np.zeros((2 * len(weights), 2 * len(weights)), dtype=np.double)
+
+    # accumulate the outer products of the smoothed endpoints a chunk of streamlines at a time
+    for start in range(0, n, args.chunk_size):
+        stop = min(start + args.chunk_size, n)
+
+        basis_in = hemisphere_sph_harm(args.num_harm, pts_in[start:stop], hemi_in[start:stop], weights)
+        basis_out = hemisphere_sph_harm(args.num_harm, pts_out[start:stop], hemi_out[start:stop], weights)
+
+        coefs += basis_in.T.dot(basis_out)
+
+        logging.info('Processed {0} of {1} streamlines.'.format(stop, n))
+
+    # connectivity is undirected
+    coefs = coefs + coefs.T
+
+    # save results
+    np.savez_compressed(args.output, coefs=coefs, num_harm=args.num_harm, sigma=args.sigma, n_fibers=n)
+
+
+if __name__ == "__main__":
+    main()
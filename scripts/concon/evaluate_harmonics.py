@@ -0,0 +1,130 @@
+import argparse
+import h5py
+import logging
+
+import numpy as np
+
+from scipy import sparse
+from os.path import isfile, splitext
+from spherical_harmonics import sc_row_blocks
+
+DESCRIPTION = """
+  Evaluate the spherical harmonic coefficients of a smoothed continuous SC on a grid (or a
+  subset of its vertices) a block of rows at a time, and write the upper triangle of the matrix
+  to the 'sc' dataset of a .h5 file as each block is evaluated, so the full matrix is never held
+  in memory. The values are the harmonic expansion of the smoothed density and are not rescaled
+  to match concon; use --reference with the output of convert_raw.py on the same (small) grid to
+  compare the two.
+"""
+
+
+def _build_args_parser():
+    p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                description=DESCRIPTION)
+
+    p.add_argument('--harmonics', action='store', metavar='HARMONICS', required=True,
+                   type=str, help='Path of the .npz file of coefficients from compute_harmonics.py.')
+
+    p.add_argument('--grid', action='store', metavar='GRID', required=True,
+                   type=str, help='Path of the .npz file of grid coordinates (output of get_coords.py).')
+
+    p.add_argument('--vertices', action='store', metavar='VERTICES', default=None,
+                   type=str, help='Path of a .npy file of grid vertex ids to evaluate, all vertices if not given.')
+
+    p.add_argument('--block_size', action='store', metavar='BLOCK_SIZE', default=5000,
+                   type=int, help='Number of grid vertices to evaluate at a time.')
+
+    p.add_argument('--reference', action='store', metavar='REFERENCE', default=None,
+                   type=str, help='Path of the .npz output of convert_raw.py on the same grid, to report the scale\n' +
+                                  'and relative difference between the two.')
+
+    p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
+                   type=str, help='Path of the .h5 file to output.')
+
+    p.add_argument('-f', action='store_true', dest='overwrite',
+                   help='If set, overwrite files if they already exist.')
+
+    return p
+
+
+def main():
+    parser = _build_args_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # make sure the input files exist
+    if not isfile(args.harmonics):
+        parser.error('The file "{0}" must exist.'.format(args.harmonics))
+
+    if not isfile(args.grid):
+        parser.error('The file "{0}" must exist.'.format(args.grid))
+
+    if args.vertices is not None and not isfile(args.vertices):
+        parser.error('The file "{0}" must exist.'.format(args.vertices))
+
+    if args.reference is not None and not isfile(args.reference):
+        parser.error('The file "{0}" must exist.'.format(args.reference))
+
+    if not splitext(args.output)[1] in ['.h5', '.hdf5']:
+        parser.error('The output must be a .h5 file.')
+
+    # make sure files are not accidently overwritten
+    if isfile(args.output):
+        if args.overwrite:
+            logging.info('Overwriting "{0}".'.format(args.output))
+        else:
+            parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
+
+    # load coefficients and grid
+    harmonics = np.load(args.harmonics)
+    coefs = harmonics['coefs']
+    num_harm = int(harmonics['num_harm'])
+
+    coords = np.load(args.grid)['coords']
+
+    if args.vertices is not None:
+        coords = coords[np.load(args.vertices).astype(np.int64)]
+
+    hemispheres = coords[:, 1].astype(np.int64)
+    points = coords[:, 2:5] / np.linalg.norm(coords[:, 2:5], axis=1).reshape(-1, 1)
+
+    n = points.shape[0]
+
+    logging.info('Evaluating {0}x{0} kernel matrix.'.format(n))
+
+    if args.reference is not None:
+        reference = sparse.load_npz(args.reference).tocsr()
+
+        if not reference.shape == (n, n):
+            parser.error('The reference must be evaluated on the same grid ({0} vertices).'.format(n))
+
+        products = np.zeros(3)
+
+    h5_file = h5py.File(args.output, 'w')
+
+    # chunks below the diagonal are never written, so only the upper triangle is stored
+    chunks = (min(args.block_size, n, 256), min(n, 256))
+    sc_dataset = h5_file.create_dataset('sc', shape=(n, n), dtype=np.double, chunks=chunks,
+                                        compression='gzip', compression_opts=1, fillvalue=0)
+
+    for start, stop, block in sc_row_blocks(coefs, num_harm, points, hemispheres, block_size=args.block_size):
+        # inner products of the two matrices, for the least squares scale between them
+        if args.reference is not None:
+            reference_block = reference[start:stop].toarray()
+            products += [np.sum(block * block), np.sum(block * reference_block), np.sum(reference_block**2)]
+
+        # zero the part of the diagonal block below the diagonal in place, and write the rest of the rows
+        block[:, start:stop][np.tril_indices(stop - start, -1)] = 0
+        sc_dataset[start:stop, start:] = block[:, start:]
+
+    h5_file.close()
+
+    if args.reference is not None:
+        scale = products[1] / products[0]
+        difference = np.sqrt(max(products[2] - scale * products[1], 0) / products[2])
+
+        logging.info('Reference = {0:.6g} x harmonic SC, with a relative difference of {1:.3g}.'.format(scale, difference))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import numpy as np
+
+
+# number of real spherical harmonic functions of degree l < num_harm
+def num_coefficients(num_harm):
+    return num_harm * num_harm
+
+
+# heat kernel weights exp(-l(l+1)sigma) for every coefficient, ordered as in real_sph_harm
+def heat_kernel_weights(num_harm, sigma):
+    degrees = np.concatenate([np.repeat(l, 2*l + 1) for l in range(num_harm)])
+    return np.exp(-degrees * (degrees + 1) * sigma)
+
+
+# evaluate all orthonormal real spherical harmonics of degree l < num_harm at the given
+# unit vectors (n x 3). columns are ordered l = 0..num_harm-1, m = -l..l.
+def real_sph_harm(num_harm, coords):
+    coords = np.asarray(coords, dtype=np.double)
+    n = coords.shape[0]
+
+    cos_theta = np.clip(coords[:, 2], -1.0, 1.0)
+    sin_theta = np.sqrt(1.0 - cos_theta**2)
+    phi = np.arctan2(coords[:, 1], coords[:, 0])
+
+    result = np.empty((n, num_coefficients(num_harm)), dtype=np.double)
+
+    # normalised associated legendre functions, built one order m at a time
+    p_mm = np.full(n, np.sqrt(1.0 / (4.0 * np.pi)))
+
+    for m in range(num_harm):
+        if m > 0:
+            p_mm = p_mm * np.sqrt((2.0*m + 1.0) / (2.0*m)) * sin_theta
+
+        if m == 0:
+            cos_m = np.ones(n)
+            sin_m = np.zeros(n)
+            scale = 1.0
+        else:
+            cos_m = np.cos(m * phi)
+            sin_m = np.sin(m * phi)
+            scale = np.sqrt(2.0)
+
+        p_prev = None
+        p_curr = p_mm
+
+        for l in range(m, num_harm):
+            if l == m + 1:
+                p_prev, p_curr = p_curr, np.sqrt(2.0*m + 3.0) * cos_theta * p_curr
+            elif l > m + 1:
+                a = np.sqrt((4.0*l*l - 1.0) / (l*l - m*m))
+                b = np.sqrt(((l - 1.0)**2 - m*m) / (4.0*(l - 1.0)**2 - 1.0))
+                p_prev, p_curr = p_curr, a * (cos_theta * p_curr - b * p_prev)
+
+            # position of Y_l^0 within the coefficient vector
+            centre = l*l + l
+
+            result[:, centre + m] = scale * p_curr * cos_m
+
+            if m > 0:
+                result[:, centre - m] = scale * p_curr * sin_m
+
+    return result
+
+
+# build the design matrix for points on both hemispheres, lh coefficients first then rh
+def hemisphere_sph_harm(num_harm, coords, hemispheres, weights=None):
+    n_coef = num_coefficients(num_harm)
+    basis = real_sph_harm(num_harm, coords)
+
+    if weights is not None:
+        basis *= weights
+
+    result = np.zeros((coords.shape[0], 2 * n_coef), dtype=np.double)
+
+    lh = (hemispheres == 0)
+    result[lh, :n_coef] = basis[lh]
+    result[~lh, n_coef:] = basis[~lh]
+
+    return result
+
+
+# evaluate the continuous SC described by the coefficient matrix between two sets of points
+def evaluate_sc(coefs, num_harm, coords_a, hemi_a, coords_b=None, hemi_b=None, block_size=5000):
+    if coords_b is None:
+        coords_b, hemi_b = coords_a, hemi_a
+
+    basis_b = hemisphere_sph_harm(num_harm, coords_b, hemi_b)
+    right = coefs.dot(basis_b.T)
+
+    result = np.empty((coords_a.shape[0], coords_b.shape[0]), dtype=np.double)
+
+    for start in range(0, coords_a.shape[0], block_size):
+        stop = min(start + block_size, coords_a.shape[0])
+        basis_a = hemisphere_sph_harm(num_harm, coords_a[start:stop], hemi_a[start:stop])
+        result[start:stop] = basis_a.dot(right)
+
+    return result
+
+
+# evaluate the continuous SC described by the coefficient matrix between a set of points and itself,
+# yielding a block of full rows at a time so the whole matrix does not have to be kept in memory
+def sc_row_blocks(coefs, num_harm, coords, hemispheres, block_size=5000):
+    right = coefs.dot(hemisphere_sph_harm(num_harm, coords, hemispheres).T)
+
+    for start in range(0, coords.shape[0], block_size):
+        stop = min(start + block_size, coords.shape[0])
+        basis = hemisphere_sph_harm(num_harm, coords[start:stop], hemispheres[start:stop])
+
+        yield start, stop, basis.dot(right)
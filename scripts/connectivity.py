@@ -0,0 +1,470 @@
+import os
+
+import nibabel as nib
+import numpy as np
+
+from scipy import sparse
+
+
+# sparse (full resolution x downsampled) matrix with a one where a full resolution
+# vertex is mapped to a downsampled vertex, built from the mapping of map_surfaces.py
+def mapping_matrix(mapping, shape):
+    sizes = np.array([len(vertices) for vertices in mapping], dtype=np.int64)
+
+    rows = np.concatenate(mapping).astype(np.int64)
+    cols = np.repeat(np.arange(len(mapping), dtype=np.int64), sizes)
+
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(shape[3], len(mapping)))
+
+
+# sparse (downsampled x full resolution) matrix whose product with full resolution data gives
+# the (weighted) mean over the vertices mapped to each downsampled vertex. without weights each
+# vertex counts once, otherwise weights holds a weight (e.g. the area) for each full resolution vertex
+def averaging_matrix(mapping, shape, weights=None, dtype=np.float64):
+    average = mapping_matrix(mapping, shape).T.tocsr()
+
+    if weights is not None:
+        average = average.dot(sparse.diags(np.asarray(weights, dtype=np.float64)))
+
+    totals = np.asarray(average.sum(axis=1)).ravel()
+    totals[totals == 0] = 1
+
+    return sparse.diags(1.0 / totals).dot(average).tocsr().astype(dtype)
+
+
+# load the averaging matrix of a mapping file, caching it so that it is only built once for every
+# subject and script that uses the same mesh. without areas each vertex counts once, and the matrix
+# is cached next to the mapping. otherwise areas is the path of a .npy file of the area of every full
+# resolution vertex (see calculate_vertex_areas.py), and the area weighted matrix is cached next to it
+def load_averaging_matrix(filename, dtype=np.float64, areas=None):
+    if areas is None:
+        cache = os.path.splitext(filename)[0] + '_averaging.npz'
+        sources = [filename]
+    else:
+        cache = os.path.splitext(areas)[0] + '_' + os.path.basename(os.path.splitext(filename)[0]) + '_averaging.npz'
+        sources = [filename, areas]
+
+    if os.path.isfile(cache) and all([os.path.getmtime(cache) >= os.path.getmtime(source) for source in sources]):
+        return sparse.load_npz(cache).astype(dtype)
+
+    mesh = np.load(filename, allow_pickle=True)
+    average = averaging_matrix(mesh['mapping'], mesh['shape'], None if areas is None else np.load(areas))
+
+    # write to a temporary file first so other processes never read a half written cache
+    tmp_file = cache + '.' + str(os.getpid()) + '.tmp'
+
+    try:
+        with open(tmp_file, 'wb') as outfile:
+            sparse.save_npz(outfile, average)
+
+        os.rename(tmp_file, cache)
+    except (IOError, OSError):
+        # the mapping may be in a read-only directory, the matrix is still usable
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+    return average.astype(dtype)
+
+
+# map an array of full resolution vertex ids to their downsampled vertex ids
+def map_vertices(ids, mapping, shape):
+    sizes = np.array([len(vertices) for vertices in mapping], dtype=np.int64)
+
+    lookup = np.full(shape[3], -1, dtype=np.int64)
+    lookup[np.concatenate(mapping).astype(np.int64)] = np.repeat(np.arange(len(mapping), dtype=np.int64), sizes)
+
+    return lookup[ids]
+
+
+# load the streamline endpoints on the white matter surfaces from a snapped (or registered)
+# intersections file, as vertex ids of the full resolution mesh (rh ids offset by lh size)
+def load_endpoints(intersections, shape):
+    surf_in = intersections['surf_ids0'].astype(np.int64)
+    surf_out = intersections['surf_ids1'].astype(np.int64)
+    id_in = intersections['v_ids0'].astype(np.int64)
+    id_out = intersections['v_ids1'].astype(np.int64)
+
+    id_in[surf_in == 1] = id_in[surf_in == 1] + shape[4]
+    id_out[surf_out == 1] = id_out[surf_out == 1] + shape[4]
+
+    mask = (surf_in < 2) & (surf_out < 2)
+
+    return id_in[mask], id_out[mask], mask
+
+
+# symmetric histogram of streamline endpoint pairs, self connections are only counted once
+def endpoint_histogram(id_in, id_out, n):
+    offdiag = ~(id_in == id_out)
+
+    rows = np.concatenate([id_in, id_out[offdiag]])
+    cols = np.concatenate([id_out, id_in[offdiag]])
+
+    histogram = sparse.coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+
+    # duplicate entries are summed when converting
+    return histogram.tocsr()
+
+
+# aggregate a histogram to a coarser resolution, as P^T H P
+def aggregate_histogram(histogram, mapping_mat):
+    return (mapping_mat.T.dot(histogram).dot(mapping_mat)).tocsr()
+
+
+# undirected key for each pair of (downsampled) vertex ids, so that (a, b) and (b, a) are the same
+def pair_keys(id_a, id_b, n):
+    id_a = np.asarray(id_a, dtype=np.int64)
+    id_b = np.asarray(id_b, dtype=np.int64)
+
+    return np.minimum(id_a, id_b) * n + np.maximum(id_a, id_b)
+
+
+# sort streamline ids by the key of their endpoint pair, the streamlines with
+# keys[i] are fiber_ids[offsets[i]:offsets[i+1]] (CSR style). streamlines with an
+# unmapped endpoint (-1 from map_vertices, so a negative key) are not indexed
+def fiber_index(keys, fiber_ids):
+    mapped = keys >= 0
+    keys = keys[mapped]
+    fiber_ids = fiber_ids[mapped]
+
+    order = np.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    fiber_ids = fiber_ids[order]
+
+    unique_keys, offsets = np.unique(keys, return_index=True)
+    offsets = np.append(offsets, len(keys))
+
+    return unique_keys, offsets, fiber_ids
+
+
+# find the ids of all streamlines with the given keys in a fiber index
+def lookup_fibers(keys, offsets, fiber_ids, query):
+    query = np.unique(query)
+    pos = np.searchsorted(keys, query)
+
+    found = pos < len(keys)
+    found[found] = (keys[pos[found]] == query[found])
+    pos = pos[found]
+
+    if len(pos) == 0:
+        return np.array([], dtype=fiber_ids.dtype)
+
+    return np.concatenate([fiber_ids[offsets[i]:offsets[i+1]] for i in pos])
+
+
+# load the streamlines of a .vtk tract file as one (points x 3) array, with the points of each streamline
+# stored contiguously so that the points of streamline i are points[offsets[i]:offsets[i+1]]
+def load_streamline_points(filename):
+    import vtk
+    import vtk.util.numpy_support as ns
+
+    reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(filename)
+    reader.Update()
+
+    tracts = reader.GetOutput()
+    points = ns.vtk_to_numpy(tracts.GetPoints().GetData())
+    lines = tracts.GetLines()
+
+    if hasattr(lines, 'GetConnectivityArray'):
+        connectivity = ns.vtk_to_numpy(lines.GetConnectivityArray()).astype(np.int64)
+        offsets = ns.vtk_to_numpy(lines.GetOffsetsArray()).astype(np.int64)
+    else:
+        # legacy cell array (n, id_1, ..., id_n, n, ...), the counts can only be found one after another
+        cells = ns.vtk_to_numpy(lines.GetData()).astype(np.int64)
+        starts = []
+        pos = 0
+
+        while pos < len(cells):
+            starts.append(pos)
+            pos += cells[pos] + 1
+
+        starts = np.array(starts, dtype=np.int64)
+        counts = cells[starts]
+
+        is_count = np.zeros(len(cells), dtype=bool)
+        is_count[starts] = True
+
+        connectivity = cells[~is_count]
+        offsets = np.append(0, np.cumsum(counts))
+
+    return points[connectivity], offsets
+
+
+# centre each row and scale it to unit norm (a z-score divided by sqrt(T)), so that the pearson
+# correlation between two rows is their dot product. rows without any variance are set to zero.
+def normalise_rows(X):
+    # single precision rows stay in single precision, but their means and norms are accumulated in double
+    dtype = np.result_type(X.dtype, np.float32)
+
+    X = X - X.mean(axis=1, dtype=np.float64).astype(dtype).reshape((-1, 1))
+    norms = np.sqrt(np.einsum('ij,ij->i', X, X, dtype=np.float64)).reshape((-1, 1))
+    norms[norms == 0] = np.inf
+
+    return X / norms.astype(dtype)
+
+
+# upper triangular correlation matrix (ones on the diagonal) between normalised rows,
+# calculated as Z Z^T for a block of rows at a time
+def triu_correlation(Z, block_size=1000):
+    n = Z.shape[0]
+    result = np.zeros((n, n), dtype=Z.dtype)
+
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        result[start:stop, start:] = np.triu(Z[start:stop].dot(Z[start:].T))
+
+    np.fill_diagonal(result, 1)
+
+    return result
+
+
+# FC of the subcortical regions from normalised rows with the n_sub subcortical rows stacked before the
+# cortical ones, as a single product of the subcortical rows with all rows. returns the upper triangular
+# (ones on the diagonal) subcortical x subcortical FC and the subcortical x cortical FC
+def subcortical_correlation(Z, n_sub):
+    corr = np.nan_to_num(Z[:n_sub].dot(Z.T))
+
+    sub_sub_fc = np.triu(corr[:, :n_sub])
+    np.fill_diagonal(sub_sub_fc, 1)
+
+    return sub_sub_fc, corr[:, n_sub:]
+
+
+# sparse (csr) upper triangular correlation matrix (ones on the diagonal) between normalised rows, keeping
+# only the strongest entries. each block of full rows is calculated as Z Z^T and only the entries with an
+# absolute value of at least the threshold, and/or the top_k largest absolute values of each row, are kept,
+# so memory is proportional to the number of kept entries. an entry is kept if it is kept in either row.
+def sparse_triu_correlation(Z, block_size=1000, top_k=None, threshold=None):
+    n = Z.shape[0]
+    rows, cols, values = [], [], []
+
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+
+        block = np.nan_to_num(Z[start:stop].dot(Z.T))
+        block[np.arange(stop - start), np.arange(start, stop)] = 0
+        magnitude = np.abs(block)
+
+        keep = magnitude > 0
+
+        if threshold is not None:
+            keep &= magnitude >= threshold
+
+        if top_k is not None and top_k < n:
+            top = np.argpartition(-magnitude, top_k - 1, axis=1)[:, :top_k]
+            in_top = np.zeros_like(keep)
+            in_top[np.arange(stop - start)[:, None], top] = True
+            keep &= in_top
+
+        block_rows, block_cols = np.nonzero(keep)
+        rows.append(block_rows + start)
+        cols.append(block_cols)
+        values.append(block[block_rows, block_cols])
+
+    kept = sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n))
+
+    # entries kept in either row (the values are the same in both), moved to the upper triangle
+    kept = kept + kept.T - kept.multiply(kept.T.astype(bool))
+
+    return (sparse.triu(kept, 1) + sparse.identity(n, dtype=kept.dtype)).tocsr()
+
+
+# maximum absolute difference between the FC calculated from two versions of the same normalised time
+# series (e.g. single and double precision), calculated a block of rows at a time. the diagonal (which is
+# always saved as one) is not compared
+def max_fc_deviation(Z, Z_reference, block_size=1000):
+    deviation = 0.0
+
+    for start in range(0, Z.shape[0], block_size):
+        stop = min(start + block_size, Z.shape[0])
+
+        block = Z[start:stop].dot(Z.T).astype(np.float64) - Z_reference[start:stop].dot(Z_reference.T)
+        block[np.arange(stop - start), np.arange(start, stop)] = 0
+        deviation = max(deviation, np.abs(np.nan_to_num(block)).max())
+
+    return deviation
+
+
+# load the time series of a .npz file, or of a directory with a .npy file per key (as written by
+# concatenate_timeseries.py), which are memory-mapped so only the rows that are used are read
+def load_time_series(filename):
+    if os.path.isdir(filename):
+        return {os.path.splitext(name)[0]: np.load(os.path.join(filename, name), mmap_mode='r')
+                for name in sorted(os.listdir(filename)) if name.endswith('.npy')}
+
+    return np.load(filename)
+
+
+# load the normalised time series (factors) saved by calculate_fc.py --low_rank, the FC between
+# any rows i and j is then Z[i].dot(Z[j]). the subcortical factors are None if there are none
+def load_fc_factors(filename):
+    factors = np.load(filename, allow_pickle=True)
+
+    Z = factors['fc_factors'].astype(np.float64)
+    sub_Z = factors['sub_fc_factors'].astype(np.float64) if 'sub_fc_factors' in factors.files else None
+
+    return Z, sub_Z
+
+
+# FC between the given rows and columns (all columns if not given) of normalised time series
+def fc_block(Z, rows, cols=None):
+    if cols is None:
+        return Z[rows].dot(Z.T)
+
+    return Z[rows].dot(Z[cols].T)
+
+
+# average FC between all pairs of vertices of each pair of rois, given a sparse (vertex x roi) matrix of
+# weights (e.g. vertex areas), calculated as (W^T Z)(W^T Z)^T so the vertex x vertex FC is never formed
+def fc_roi_average(Z, weights):
+    roi_factors = np.asarray(weights.T.dot(Z))
+    totals = np.asarray(weights.sum(axis=0)).ravel()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return roi_factors.dot(roi_factors.T) / np.outer(totals, totals)
+
+
+# sparse (vertex x roi) matrix of vertex weights (e.g. areas) for the rois of an atlas
+def roi_weights(grouping, rois, weights):
+    cols = np.searchsorted(rois, grouping)
+    cols[cols == len(rois)] = 0
+    member = (rois[cols] == grouping)
+
+    rows = np.flatnonzero(member)
+
+    return sparse.csr_matrix((weights[rows], (rows, cols[rows])), shape=(len(grouping), len(rois)))
+
+
+# write the upper triangular correlation matrix (ones on the diagonal) between normalised rows
+# to an on-disk (e.g. hdf5) dataset one block of rows at a time, so only a block is in memory.
+# values with an absolute value below the threshold are set to zero. the block is modified in place, so
+# apart from the product only the conversion to the dataset type (if any) needs memory
+def write_triu_correlation(Z, dataset, block_size=1000, threshold=None):
+    n = Z.shape[0]
+
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+
+        block = Z[start:stop].dot(Z[start:].T)
+
+        # only the first (stop - start) columns of the block have entries below the diagonal
+        lower = np.tril_indices(stop - start, -1)
+        block[lower] = 0
+        block[np.arange(stop - start), np.arange(stop - start)] = 1
+        np.nan_to_num(block, copy=False)
+
+        if threshold is not None:
+            block[(block < threshold) & (block > -threshold)] = 0
+
+        dataset[start:stop, start:] = block
+
+
+# read a surface time series image (vertices x 1 x 1 x time) a block of vertices at a time
+# through the image proxy, so the whole image is never loaded into memory. a compressed image
+# would be decompressed in full for every block, so it is read once (in its stored type) instead
+def surface_blocks(filename, block_size=10000, dtype=np.float64):
+    proxy = nib.load(filename).dataobj
+
+    if filename.endswith('.gz'):
+        proxy = np.asanyarray(proxy)
+
+    for start in range(0, proxy.shape[0], block_size):
+        stop = min(start + block_size, proxy.shape[0])
+
+        yield start, stop, np.asarray(proxy[start:stop, 0, 0, :], dtype=dtype)
+
+
+# read a surface time series image as a (vertices x time) array, a block of vertices at a time
+def load_surface_time_series(filename, block_size=10000, dtype=np.float64):
+    shape = nib.load(filename).shape
+    time_series = np.empty([shape[0], shape[3]], dtype=dtype)
+
+    for start, stop, block in surface_blocks(filename, block_size, dtype):
+        time_series[start:stop] = block
+
+    return time_series
+
+
+# voxel coordinates of each roi of a label image, so that the label image is only read once
+def roi_voxels(label_filename, rois):
+    label_data = np.asarray(nib.load(label_filename).dataobj).astype('int')
+
+    return [np.nonzero(label_data == roi) for roi in rois]
+
+
+# gather the (voxels x time) time series of each roi (given as voxel coordinates) from a volume
+# time series, reading only the bounding box of each roi instead of the whole volume
+def load_roi_time_series(filename, voxels, dtype=np.float64):
+    proxy = nib.load(filename).dataobj
+
+    time_series = []
+
+    for xyz in voxels:
+        if len(xyz[0]) == 0:
+            time_series.append(np.empty([0, proxy.shape[3]], dtype=dtype))
+            continue
+
+        lower = [axis.min() for axis in xyz]
+        upper = [axis.max() + 1 for axis in xyz]
+
+        box = proxy[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2], :]
+        time_series.append(np.asarray(box[xyz[0] - lower[0], xyz[1] - lower[1], xyz[2] - lower[2]], dtype=dtype))
+
+    return time_series
+
+
+# rows (after transposing) of the fsfast nuisance regressor files used as confounders: the six
+# motion parameters of fmcpr.mcdat (after the time point number) and the first five principal
+# components of the white matter (wm.dat) and ventricle/csf (vcsf.dat) signals
+MOTION_COLUMNS = slice(1, 7)
+WM_COLUMNS = slice(0, 5)
+VCSF_COLUMNS = slice(0, 5)
+
+
+# (time x confounders) matrix of a constant, the fsfast nuisance regressors that are given
+# (empty filenames are skipped, and the columns of each file that are used can be given)
+# and polynomial terms up to the given order for detrending
+def load_confounders(n, motion='', wm='', vcsf='', gsl='', detrend=2, motion_columns=MOTION_COLUMNS,
+                     wm_columns=WM_COLUMNS, vcsf_columns=VCSF_COLUMNS):
+    confounders = np.ones([1, n])
+
+    if not motion == '':
+        confounders = np.concatenate([confounders, np.genfromtxt(motion, dtype=np.float64).T[motion_columns, :]])
+
+    if not wm == '':
+        confounders = np.concatenate([confounders, np.genfromtxt(wm, dtype=np.float64).T[wm_columns, :]])
+
+    if not vcsf == '':
+        confounders = np.concatenate([confounders, np.genfromtxt(vcsf, dtype=np.float64).T[vcsf_columns, :]])
+
+    if not gsl == '':
+        confounders = np.concatenate([confounders, np.genfromtxt(gsl).reshape([1, n])])
+
+    # add time polynomial terms to detrend the timeseries
+    if not detrend == 0:
+        time = np.full((1,n), range(n))
+        confounders = np.concatenate([confounders, np.vstack([time**i for i in range(1, detrend+1)])]) 
+
+    return confounders.T
+
+
+# remove the part of each row of time series explained by the confounders, Y - X (X^+ Y) with
+# X^+ Y calculated from the thin QR decomposition (q) of the confounders
+def regress_out(time_series, q):
+    return time_series - time_series.dot(q).dot(q.T)
+
+
+# FC between the mean cortical time series and, if given, the mean subcortical time series, with the
+# same keys and layout as calculate_fc.py (upper triangular fc and sub_sub_fc, sub x vertex sub_surf_fc)
+def functional_connectivity(mean_time_series, sub_mean_time_series=None, block_size=1000):
+    if sub_mean_time_series is None:
+        return {'fc': np.nan_to_num(triu_correlation(normalise_rows(mean_time_series), block_size))}
+
+    # the subcortical rows are stacked before the cortical ones and normalised together
+    n_sub = len(sub_mean_time_series)
+    Z = normalise_rows(np.concatenate([sub_mean_time_series, mean_time_series]))
+
+    result = {'fc': np.nan_to_num(triu_correlation(Z[n_sub:], block_size))}
+    result['sub_sub_fc'], result['sub_surf_fc'] = subcortical_correlation(Z, n_sub)
+
+    return result
@@ -4,6 +4,7 @@ import nibabel as nib
 import numpy as np
 
 from os.path import isfile, splitext
+from connectivity import load_surface_time_series, roi_voxels, load_roi_time_series
 
 DESCRIPTION = """
   Regress out the given confounders from the timeseries data.
@@ -29,6 +30,12 @@ def _build_args_parser():
     p.add_argument('--sub_rois', nargs='+', metavar='SUB_ROIS', required=False, default=None,
                    type=int, help='Labels of the subcortical ROIs to calculate the FC for.')
 
+    p.add_argument('--block_size', action='store', metavar='BLOCK_SIZE', required=False, default=10000,
+                   type=int, help='Number of vertices to read at a time.')
+
+    p.add_argument('--float32', action='store_true', dest='float32',
+                   help='If set, save the time series in single precision.')
+
     p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
                    type=str, help='Path of the .npz file to save the output to.')
 
@@ -68,33 +75,22 @@ def main():
         else:
             parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
 
-    # load time series for left and right hemispheres
-    time_series_lh = nib.load(args.lh_time_series)
-    time_series_data_lh = time_series_lh.get_data()
-    time_series_data_lh = time_series_data_lh[:, 0, 0, :]
+    dtype = np.float32 if args.float32 else np.float64
 
-    time_series_rh = nib.load(args.rh_time_series)
-    time_series_data_rh = time_series_rh.get_data()
-    time_series_data_rh = time_series_data_rh[:, 0, 0, :]
+    # load time series for left and right hemispheres, a block of vertices at a time
+    time_series_data_lh = load_surface_time_series(args.lh_time_series, args.block_size, dtype)
+    time_series_data_rh = load_surface_time_series(args.rh_time_series, args.block_size, dtype)
 
     time_series = dict()
 
-    logging.info('Calculating timeseries for subcortical regions')   
- 
     # load time series for subcortical regions
     if has_subcortical == True:
-        ts_data = nib.load(args.sub_time_series)
-        ts_data = ts_data.get_data()
-
-        # load label images
-        label_img = nib.load(args.aparc)
-        label_data = label_img.get_data().astype('int')
+        logging.info('Calculating timeseries for subcortical regions')   
 
-        for roi in args.sub_rois:
-            xyz = np.nonzero(label_data == roi)
+        roi_time_series = load_roi_time_series(args.sub_time_series, roi_voxels(args.aparc, args.sub_rois), dtype)
 
-            label_name = 'label_' + str(roi)
-            time_series[label_name] = ts_data[xyz]
+        for roi, roi_data in zip(args.sub_rois, roi_time_series):
+            time_series['label_' + str(roi)] = roi_data
 
     # save the results
     time_series['lh_time_series'] = time_series_data_lh
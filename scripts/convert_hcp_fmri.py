@@ -8,7 +8,9 @@ import scipy.io as scio
 from os.path import isfile
 
 DESCRIPTION = """
-  Extract BOLD series for left and right white surfaces from HCP results.
+  Extract BOLD series for left and right white surfaces, and the subcortical structures (saved with
+  the freesurfer aseg label of each structure), from HCP results. The CIFTI file is read a block of
+  time points at a time into preallocated (vertex x time) outputs.
 """
 
 
@@ -22,12 +24,38 @@ def _build_args_parser():
     p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
                    type=str, help='Path of the .npz file to save the output to.')
 
+    p.add_argument('--block_size', action='store', metavar='BLOCK_SIZE', required=False, default=100,
+                   type=int, help='Number of time points to read at a time.')
+
+    p.add_argument('--float64', action='store_true', dest='float64',
+                   help='If set, save the time series in double precision (single precision by default).')
+
     p.add_argument('-f', action='store_true', dest='overwrite',
                    help='If set, overwrite files if they already exist.')
 
     return p
 
 
+# freesurfer aseg label of each subcortical CIFTI structure that is extracted
+ASEG_LABELS = {
+    'CIFTI_STRUCTURE_ACCUMBENS_LEFT': 26,
+    'CIFTI_STRUCTURE_ACCUMBENS_RIGHT': 58,
+    'CIFTI_STRUCTURE_AMYGDALA_LEFT': 18,
+    'CIFTI_STRUCTURE_AMYGDALA_RIGHT': 54,
+    'CIFTI_STRUCTURE_BRAIN_STEM': 16,
+    'CIFTI_STRUCTURE_CAUDATE_LEFT': 11,
+    'CIFTI_STRUCTURE_CAUDATE_RIGHT': 50,
+    'CIFTI_STRUCTURE_HIPPOCAMPUS_LEFT': 17,
+    'CIFTI_STRUCTURE_HIPPOCAMPUS_RIGHT': 53,
+    'CIFTI_STRUCTURE_PALLIDUM_LEFT': 13,
+    'CIFTI_STRUCTURE_PALLIDUM_RIGHT': 52,
+    'CIFTI_STRUCTURE_PUTAMEN_LEFT': 12,
+    'CIFTI_STRUCTURE_PUTAMEN_RIGHT': 51,
+    'CIFTI_STRUCTURE_THALAMUS_LEFT': 10,
+    'CIFTI_STRUCTURE_THALAMUS_RIGHT': 49,
+}
+
+
 def main():
     parser = _build_args_parser()
     args = parser.parse_args()
@@ -44,64 +72,45 @@ def main():
         else:
             parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
 
+    dtype = np.float64 if args.float64 else np.float32
+
     # load data
     fmri_data = nib.load(args.time_series)
     header = fmri_data.header.get_axis(1)
-
-    lh_n = header.to_mapping(1)[0].surface_number_of_vertices
-    lh_count = header.to_mapping(1)[0].index_count
-    lh_offset = header.to_mapping(1)[0].index_offset
-    
-    rh_n = header.to_mapping(1)[1].surface_number_of_vertices
-    rh_count = header.to_mapping(1)[1].index_count
-    rh_offset = header.to_mapping(1)[1].index_offset
-
-    lh_indices = np.array(header.vertex[lh_offset:(lh_offset+lh_count)])
-    rh_indices = np.array(header.vertex[rh_offset:(rh_offset+rh_count)])
-
     ts_size = fmri_data.header.get_axis(0).size
 
-    # save time series for left and right hemispheres
-    lh_time_series = np.zeros((ts_size, lh_n))
-    rh_time_series = np.zeros((ts_size, rh_n))
-
-    lh_time_series[:,lh_indices] = fmri_data.dataobj[:, lh_offset:(lh_offset+lh_count)]
-    rh_time_series[:,rh_indices] = fmri_data.dataobj[:, rh_offset:(rh_offset+rh_count)]
+    # (output key, slice of the grayordinates, vertex indices) of each part that is extracted
+    parts = []
+    time_series = dict()
+    labels = []
 
-    tmp_time_series = dict()
+    for name, slc, bm in header.iter_structures():
+        if name == 'CIFTI_STRUCTURE_CORTEX_LEFT' or name == 'CIFTI_STRUCTURE_CORTEX_RIGHT':
+            key = 'lh_time_series' if name == 'CIFTI_STRUCTURE_CORTEX_LEFT' else 'rh_time_series'
 
-    for idx, (name, slc, bm) in enumerate(header.iter_structures()):
-        if idx < 2:
-            continue
+            # vertices of the medial wall are not in the CIFTI file and are left as zeros
+            time_series[key] = np.zeros((bm.nvertices[name], ts_size), dtype=dtype)
+            parts.append((key, slc, np.array(bm.vertex)))
+        elif name in ASEG_LABELS:
+            key = 'label_' + str(ASEG_LABELS[name])
 
-        tmp_time_series[idx] = fmri_data.dataobj[:,slc].T
-
-    sc_time_series = dict()
-
-    sc_time_series['label_18'] = tmp_time_series[4]
-    sc_time_series['label_54'] = tmp_time_series[5]
-    sc_time_series['label_11'] = tmp_time_series[7]
-    sc_time_series['label_50'] = tmp_time_series[8]
-    sc_time_series['label_17'] = tmp_time_series[13]
-    sc_time_series['label_53'] = tmp_time_series[14]
-    sc_time_series['label_13'] = tmp_time_series[15]
-    sc_time_series['label_52'] = tmp_time_series[16]
-    sc_time_series['label_12'] = tmp_time_series[17]
-    sc_time_series['label_51'] = tmp_time_series[18]
-    sc_time_series['label_10'] = tmp_time_series[19]
-    sc_time_series['label_49'] = tmp_time_series[20]
+            time_series[key] = np.empty((len(bm), ts_size), dtype=dtype)
+            parts.append((key, slc, slice(None)))
+            labels.append(key)
+        else:
+            logging.info('Skipping {0}.'.format(name))
 
-    sc_time_series['label_16'] = tmp_time_series[6]
-    sc_time_series['label_26'] = tmp_time_series[2]
-    sc_time_series['label_58'] = tmp_time_series[3]
+    # read the time series a block of time points at a time
+    for start in range(0, ts_size, args.block_size):
+        stop = min(start + args.block_size, ts_size)
+        block = np.asarray(fmri_data.dataobj[start:stop, :])
 
-    sc_time_series['lh_time_series'] = lh_time_series.T
-    sc_time_series['rh_time_series'] = rh_time_series.T
+        for key, slc, indices in parts:
+            time_series[key][indices, start:stop] = block[:, slc].T
 
-    #np.savez_compressed(args.cor_output, lh_time_series=lh_time_series.T, 
-    #                                     rh_time_series=rh_time_series.T)
+    time_series['subcortical_labels'] = labels
 
-    kwargs = {key: sc_time_series[key] for key in sc_time_series.keys()}
+    kwargs = {key: time_series[key] for key in time_series.keys()}
     np.savez_compressed(args.output, **kwargs)
 
 
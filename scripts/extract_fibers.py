@@ -1,14 +1,16 @@
 import argparse
 import logging
 import numpy as np
-import vtk
 
-from scilpy.io.vtk_streamlines import load_vtk_streamlines, save_vtk_streamlines
-from scipy import sparse
-from os.path import isfile
+from scilpy.io.vtk_streamlines import save_vtk_streamlines
+from os.path import isfile, splitext
+from connectivity import load_endpoints, map_vertices, pair_keys, fiber_index, lookup_fibers, \
+                         load_streamline_points
 
 DESCRIPTION = """
-  Extract and save fibers between two given ROIs.
+  Extract and save fibers between pairs of given ROIs. If the index was generated with the tracts,
+  only the points of the selected streamlines are read (from a memory map of <index>_points.npy),
+  otherwise the whole tract file is read.
 """
 
 
@@ -16,23 +18,26 @@ def _build_args_parser():
     p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
                                 description=DESCRIPTION)
 
-    p.add_argument('--intersections', action='store', metavar='INTERSECTIONS', required=True,
-                   type=str, help='Path of the .npz file of intersections.')
+    p.add_argument('--intersections', action='store', metavar='INTERSECTIONS', default=None,
+                   type=str, help='Path of the .npz file of intersections (not needed if --index is given).')
 
-    p.add_argument('--tracts', action='store', metavar='TRACTS', required=True,
-                   type=str, help='Path of the .npz file of tracts.')
+    p.add_argument('--mesh', action='store', metavar='MESH', default=None,
+                   type=str, help='Path to the downsampled (atlas) mesh .npz file (not needed if --index is given).')
 
-    p.add_argument('--mesh', action='store', metavar='MESH', required=True,
-                   type=str, help='Path to the downsampled (atlas) mesh .npz file.')
+    p.add_argument('--index', action='store', metavar='INDEX', default=None,
+                   type=str, help='Path of the .npz file of the fiber index (output of generate_fiber_index.py).')
 
-    p.add_argument('--roi_a', action='store', metavar='ROI_a', required=True,
-                   type=int, help='ID of the first ROI to check.')
+    p.add_argument('--tracts', action='store', metavar='TRACTS', default=None,
+                   type=str, help='Path of the .vtk (.fib) file of tracts (not needed if the index has their points).')
 
-    p.add_argument('--roi_b', action='store', metavar='ROI_b', required=True,
-                   type=int, help='ID of the second ROI to check.')
+    p.add_argument('--roi_a', type=int, nargs='+', required=True,
+                   help='IDs of the first ROI of each pair to check.')
+
+    p.add_argument('--roi_b', type=int, nargs='+', required=True,
+                   help='IDs of the second ROI of each pair to check.')
 
     p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
-                   type=str, help='Path of the .npz file of structural connectivity matrix.')
+                   type=str, help='Path of the .vtk (.fib) file to save the fibers to.')
 
     p.add_argument('-f', action='store_true', dest='overwrite',
                    help='If set, overwrite files if they already exist.')
@@ -40,20 +45,41 @@ def _build_args_parser():
     return p
 
 
+# get only the streamlines with the given ids, given the points of all streamlines (e.g. as a memory
+# map, from which only the selected ranges are read) and the offsets of the points of each streamline
+def select_streamlines(points, offsets, fiber_ids):
+    return [np.array(points[offsets[i]:offsets[i+1]]) for i in fiber_ids]
+
+
 def main():
     parser = _build_args_parser()
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
 
     # make sure the input files exist
-    if not isfile(args.intersections):
-        parser.error('The file "{0}" must exist.'.format(args.intersections))
+    if args.index is None:
+        if args.intersections is None or args.mesh is None:
+            parser.error('Either --index, or both --intersections and --mesh must be given.')
+
+        if not isfile(args.intersections):
+            parser.error('The file "{0}" must exist.'.format(args.intersections))
+
+        if not isfile(args.mesh):
+            parser.error('The file "{0}" must exist.'.format(args.mesh))
+    elif not isfile(args.index):
+        parser.error('The file "{0}" must exist.'.format(args.index))
+
+    points_file = splitext(args.index)[0] + '_points.npy' if args.index is not None else None
+    has_points = points_file is not None and isfile(points_file)
 
-    if not isfile(args.tracts):
+    if args.tracts is None and not has_points:
+        parser.error('--tracts must be given if the index does not have the points of the tracts.')
+
+    if args.tracts is not None and not isfile(args.tracts):
         parser.error('The file "{0}" must exist.'.format(args.tracts))
 
-    if not isfile(args.mesh):
-        parser.error('The file "{0}" must exist.'.format(args.mesh))
+    if not len(args.roi_a) == len(args.roi_b):
+        parser.error('--roi_a and --roi_b must have the same number of ROIs.')
 
     # make sure files are not accidently overwritten
     if isfile(args.output):
@@ -62,58 +88,45 @@ def main():
         else:
             parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
 
-    logging.info('Loading mapping and intersections.')
-
-    # load mapping for the given resolution
-    mesh = np.load(args.mesh, allow_pickle=True)
-
-    mapping = mesh['mapping']
-    shape = mesh['shape']
-
-    # load intersections that have already been snapped to nearest vertices of full mesh
-    intersections = np.load(args.intersections, allow_pickle=True)
-
-    tri_ids0 = intersections['tri_ids0'].astype(np.int64)
-    tri_ids1 = intersections['tri_ids1'].astype(np.int64)
-    id_in = intersections['v_ids0'].astype(np.int64)
-    id_out = intersections['v_ids1'].astype(np.int64)
-
-    # only keep the white matter surfaces from the intersections 
-    # file and map rh vertex ids to the full brain indices
-    rh_surface_mask_in = (tri_ids0 > lh_limit) & (tri_ids0 <= rh_limit)
-    rh_surface_mask_out = (tri_ids1 > lh_limit) & (tri_ids1 <= rh_limit)
+    if args.index is not None:
+        logging.info('Loading fiber index.')
 
-    id_in[rh_surface_mask_in] = id_in[rh_surface_mask_in] + shape[4]
-    id_out[rh_surface_mask_out] = id_out[rh_surface_mask_out] + shape[4]
+        index = np.load(args.index)
 
-    surface_mask = (tri_ids0 <= rh_limit) & (tri_ids1 <= rh_limit)
+        keys = index['keys']
+        offsets = index['offsets']
+        fiber_ids = index['fiber_ids']
+        n = int(index['n'])
+    else:
+        logging.info('Loading mapping and intersections.')
 
-    id_in = id_in[surface_mask]
-    id_out = id_out[surface_mask]
+        # load mapping for the given resolution
+        mesh = np.load(args.mesh, allow_pickle=True)
 
-    logging.info('Calculating SC for ' + str(len(id_in)) + ' streamlines.')
+        mapping = mesh['mapping']
+        shape = mesh['shape']
+        n = shape[0]
 
-    id_in_buf = id_in.copy()
-    id_out_buf = id_out.copy()
+        # load intersections that have already been snapped to nearest vertices of full mesh
+        intersections = np.load(args.intersections, allow_pickle=True)
+        id_in, id_out, surface_mask = load_endpoints(intersections, shape)
 
-    # map intersections to the given resolution
-    for i in range(shape[0]):
-        id_in[np.in1d(id_in_buf, mapping[i])] = i
-        id_out[np.in1d(id_out_buf, mapping[i])] = i
+        keys = pair_keys(map_vertices(id_in, mapping, shape), map_vertices(id_out, mapping, shape), n)
+        keys, offsets, fiber_ids = fiber_index(keys, np.flatnonzero(surface_mask))
 
-    mask = np.zeros(len(id_in), np.bool)
+    # find the streamlines between each pair of ROIs
+    selected = lookup_fibers(keys, offsets, fiber_ids, pair_keys(args.roi_a, args.roi_b, n))
+    selected = np.sort(selected)
 
-    # calculate the structural connectivity
-    for i in range(len(id_in)):
-        if id_in[i] == args.roi_a and id_out[i] == args.roi_b:
-            mask[i] = True
+    logging.info('Extracting ' + str(len(selected)) + ' streamlines.')
 
-        if id_in[i] == args.roi_b and id_out[i] == args.roi_a:
-            mask[i] = True
+    if has_points:
+        points = np.load(points_file, mmap_mode='r')
+        point_offsets = index['point_offsets']
+    else:
+        points, point_offsets = load_streamline_points(args.tracts)
 
-    tracts = load_vtk_streamlines(args.tracts)
-    filtered_tracts = np.array(tracts)[surface_mask]
-    filtered_tracts = filtered_tracts[mask]
+    filtered_tracts = select_streamlines(points, point_offsets, selected)
 
     save_vtk_streamlines(filtered_tracts, args.output, binary = True)
 
@@ -3,10 +3,9 @@ import logging
 import numpy as np
 import tractconverter as tc
 
+from multiprocessing import Pool
 from os.path import isfile
 
-from dipy.tracking import metrics
-from dipy.tracking.streamline import length
 from scilpy.io.vtk_streamlines import load_vtk_streamlines, save_vtk_streamlines
 
 DESCRIPTION = """
@@ -39,12 +38,78 @@ def _build_args_parser():
     p.add_argument('--max_length', action='store', metavar='MAX_LENGTH', required=False, default=200,
                    type=int, help='Maximum length (in mm increments) for streamlines before before filtering.')
 
+    p.add_argument('--batch_size', action='store', metavar='BATCH_SIZE', required=False, default=50000,
+                   type=int, help='Number of streamlines to filter at a time.')
+
+    p.add_argument('--processes', action='store', metavar='PROCESSES', required=False, default=1,
+                   type=int, help='Number of processes to filter batches of streamlines in parallel.')
+
     p.add_argument('-f', action='store_true', dest='overwrite',
                    help='If set, overwrite files if they already exist.')
 
     return p
 
 
+# length of each streamline from a flat buffer of points, where
+# streamline i is made up of points[offsets[i]:offsets[i+1]]
+def streamline_lengths(points, offsets):
+    segments = np.sqrt(np.sum(np.diff(points, axis=0)**2, axis=1))
+    cumulative = np.concatenate([[0], np.cumsum(segments), [0]])
+
+    # segments joining the end of one streamline to the start of the next are never included
+    last = np.maximum(offsets[1:] - 1, offsets[:-1])
+
+    return cumulative[last] - cumulative[offsets[:-1]]
+
+
+# total turning angle (in degrees) of each streamline projected onto its first two principal
+# axes, from a flat buffer of points (same as dipy.tracking.metrics.winding for each streamline)
+def streamline_windings(points, offsets):
+    n = len(offsets) - 1
+    counts = np.diff(offsets)
+    ids = np.repeat(np.arange(n), counts)
+
+    # centre each streamline
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.vstack([np.bincount(ids, weights=points[:, k], minlength=n) for k in range(3)]).T
+        centred = points - (means / counts.reshape(-1, 1))[ids]
+
+    # principal axes of each streamline from its covariance matrix
+    cov = np.empty((n, 3, 3))
+
+    for a in range(3):
+        for b in range(a, 3):
+            cov[:, a, b] = cov[:, b, a] = np.bincount(ids, weights=centred[:, a] * centred[:, b], minlength=n)
+
+    axes = np.linalg.eigh(cov)[1][:, :, 1:]
+    proj = np.einsum('ij,ijk->ik', centred, axes[ids])
+
+    # angle between consecutive projected points of the same streamline
+    v0 = proj[:-1]
+    v1 = proj[1:]
+    same = (ids[:-1] == ids[1:])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos_angle = np.sum(v0 * v1, axis=1) / (np.sqrt(np.sum(v0**2, axis=1)) * np.sqrt(np.sum(v1**2, axis=1)))
+
+    angles = np.arccos(np.clip(cos_angle[same], -1, 1))
+
+    return np.rad2deg(np.bincount(ids[:-1][same], weights=angles, minlength=n))
+
+
+# filter a batch of streamlines given as a flat buffer of points and offsets
+def filter_batch(batch):
+    points, offsets, min_length, max_length, angle = batch
+
+    lengths = streamline_lengths(points, offsets)
+    mask = (lengths <= max_length) & (lengths >= min_length)
+
+    with np.errstate(invalid='ignore'):
+        mask[mask] = (streamline_windings(points, offsets)[mask] < angle)
+
+    return mask
+
+
 def main():
     parser = _build_args_parser()
     args = parser.parse_args()
@@ -85,28 +150,33 @@ def main():
     pts1 = intersections['pts1']
 
     # load the streamlines
-    streamlines = load_vtk_streamlines(args.streamlines)
+    streamlines = list(load_vtk_streamlines(args.streamlines))
 
     logging.info('Filtering streamlines with angles >= {0} and length outside range {1}-{2}mm.'.format(args.angle, args.min_length, args.max_length))
 
     n = len(tri_ids0)
-    i = 0
-    mask = np.zeros(n, np.bool)
+
+    # flatten batches of streamlines into buffers of points with offsets
+    def batches():
+        for start in range(0, len(streamlines), args.batch_size):
+            batch = streamlines[start:start + args.batch_size]
+            offsets = np.concatenate([[0], np.cumsum([len(s) for s in batch])]).astype(np.int64)
+
+            yield (np.concatenate(batch).astype(np.double), offsets, args.min_length, args.max_length, args.angle)
 
     # create the mask for filtering
-    for s in streamlines:
-        s_filter = (length(s) <= args.max_length) & (length(s) >= args.min_length)
+    if args.processes > 1:
+        pool = Pool(args.processes)
+        masks = list(pool.imap(filter_batch, batches()))
+        pool.close()
+    else:
+        masks = [filter_batch(batch) for batch in batches()]
 
-        if s_filter:
-            s_filter = (metrics.winding(s) < args.angle)
-        
-        mask[i] = s_filter
-        
-        i = i + 1
+    mask = np.concatenate(masks) if len(masks) > 0 else np.zeros(n, dtype=bool)
 
     # save the filtered tractography if requested
     if not args.output_tracts is None:
-        filtered_tracts = np.array(streamlines)[mask]
+        filtered_tracts = [s for s, keep in zip(streamlines, mask) if keep]
         save_vtk_streamlines(filtered_tracts, args.output_tracts, binary = True)
 
     remaining = np.sum(mask)
@@ -0,0 +1,100 @@
+import argparse
+import logging
+
+import numpy as np
+
+from os.path import isfile
+from os.path import splitext
+from connectivity import load_endpoints, map_vertices, pair_keys, fiber_index, load_streamline_points
+
+DESCRIPTION = """
+  Generate an index of streamline ids sorted by the pair of downsampled vertices (or atlas
+  ROIs) at their endpoints, so that extract_fibers.py can find the streamlines between any
+  pair of vertices without mapping all intersections again. If the tracts are given, their points
+  are also saved (uncompressed, next to the index as <output>_points.npy) with the offsets of each
+  streamline, so that extract_fibers.py can read only the selected streamlines from a memory map.
+"""
+
+
+def _build_args_parser():
+    p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                description=DESCRIPTION)
+
+    p.add_argument('--intersections', action='store', metavar='INTERSECTIONS', required=True,
+                   type=str, help='Path of the .npz file of intersections that have been snapped to nearest vertices.')
+
+    p.add_argument('--mesh', action='store', metavar='MESH', required=True,
+                   type=str, help='Path to the downsampled (atlas) mesh .npz file.')
+
+    p.add_argument('--tracts', action='store', metavar='TRACTS', default=None,
+                   type=str, help='Path of the .vtk (.fib) file of tracts (in the same order as the intersections).')
+
+    p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
+                   type=str, help='Path of the .npz file to save the index to.')
+
+    p.add_argument('-f', action='store_true', dest='overwrite',
+                   help='If set, overwrite files if they already exist.')
+
+    return p
+
+
+def main():
+    parser = _build_args_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # make sure the input files exist
+    if not isfile(args.intersections):
+        parser.error('The file "{0}" must exist.'.format(args.intersections))
+
+    if not isfile(args.mesh):
+        parser.error('The file "{0}" must exist.'.format(args.mesh))
+
+    if args.tracts is not None and not isfile(args.tracts):
+        parser.error('The file "{0}" must exist.'.format(args.tracts))
+
+    # make sure files are not accidently overwritten
+    if isfile(args.output):
+        if args.overwrite:
+            logging.info('Overwriting "{0}".'.format(args.output))
+        else:
+            parser.error('The file "{0}" already exists. Use -f to overwrite it.'.format(args.output))
+
+    logging.info('Loading mapping and intersections.')
+
+    # load mapping for the given resolution
+    mesh = np.load(args.mesh, allow_pickle=True)
+
+    mapping = mesh['mapping']
+    shape = mesh['shape']
+
+    # load intersections that have already been snapped to nearest vertices of full mesh
+    intersections = np.load(args.intersections, allow_pickle=True)
+    id_in, id_out, surface_mask = load_endpoints(intersections, shape)
+
+    logging.info('Indexing ' + str(len(id_in)) + ' streamlines.')
+
+    # streamline ids are the positions in the intersections (and tract) file
+    fiber_ids = np.flatnonzero(surface_mask)
+
+    keys = pair_keys(map_vertices(id_in, mapping, shape), map_vertices(id_out, mapping, shape), shape[0])
+
+    keys, offsets, fiber_ids = fiber_index(keys, fiber_ids)
+
+    index = dict(keys=keys, offsets=offsets, fiber_ids=fiber_ids, n=shape[0])
+
+    # copy the points of the tracts to a file that can be memory mapped
+    if args.tracts is not None:
+        logging.info('Saving the points of the tracts.')
+
+        points, point_offsets = load_streamline_points(args.tracts)
+
+        np.save(splitext(args.output)[0] + '_points.npy', points)
+        index['point_offsets'] = point_offsets
+
+    # save results
+    np.savez_compressed(args.output, **index)
+
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,9 @@ def _build_args_parser():
     p.add_argument('--output', action='store', metavar='OUTPUT', required=True,
                    type=str, help='Path of the .npz file to save the output to.')
 
+    p.add_argument('--float32', action='store_true', dest='float32',
+                   help='If set, save the registered time series in single precision.')
+
     p.add_argument('-f', action='store_true', dest='overwrite',
                    help='If set, overwrite files if they already exist.')
 
@@ -146,9 +149,11 @@ def main():
     time_series[0] = time_series_data['lh_time_series']
     time_series[1] = time_series_data['rh_time_series']
 
+    dtype = np.float32 if args.float32 else np.double
+
     final_time_series = dict()
-    final_time_series[0] = np.zeros((lh_orig_n, time_series[0].shape[1]), np.double)
-    final_time_series[1] = np.zeros((rh_orig_n, time_series[1].shape[1]), np.double)
+    final_time_series[0] = np.zeros((lh_orig_n, time_series[0].shape[1]), dtype)
+    final_time_series[1] = np.zeros((rh_orig_n, time_series[1].shape[1]), dtype)
 
     # initialise pointers for cell locator
     intersection = [0, 0, 0]